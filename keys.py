@@ -11,19 +11,37 @@ from cryptography.hazmat.backends \
 from cryptography.hazmat.primitives.hashes \
     import SHA256
 from cryptography.hazmat.primitives.ciphers.aead \
-    import AESGCM
+    import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.asymmetric.x25519 \
+    import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.asymmetric.ed25519 \
+    import Ed25519PrivateKey, Ed25519PublicKey
 from cryptography.hazmat.primitives.kdf.hkdf \
     import HKDF
 from cryptography.hazmat.primitives.serialization \
     import Encoding, PublicFormat
 
-from cryptography.exceptions import InvalidSignature
+from cryptography.exceptions import InvalidSignature, InvalidTag
 
 import shared
-import pickle
+import wire
 import time
 import random
 import os
+import threading
+import collections
+import copy
+
+# private keys kept ready by KeyHelper; 0 generates them inline
+KEY_POOL_SIZE = int(os.environ.get('SIGNALPY_KEY_POOL', '32'))
+# decoded public keys kept by KeyHelper
+PK_CACHE_SIZE = 1024
+# most message keys a single received message may make a session skip
+MAX_SKIP = int(os.environ.get('SIGNALPY_MAX_SKIP', '1000'))
+# skipped message keys kept per session, the oldest are evicted first
+SKIPPED_KEYS_SIZE = 2000
+# previous ratchet keys of the other party remembered per session
+OP_RCHPK_HISTORY = 64
 
 #================ metaclasses ============================ 
 class Singleton(type):
@@ -58,6 +76,50 @@ def indent_nested(s):
 
 
 #------------- crypto helpers ---------------------------------
+class SaltGenerator():
+    '''
+    Chain of salts derived from the initial seed: every salt reseeds
+    the generator with a number drawn from the previous seed. Both
+    parties of a session start from the same seed, hence they derive
+    the same salts as long as they call new_salt in the same order.
+
+    Each generator owns its random.Random, so the sessions of one
+    process do not interfere with each other. Thread-safe.
+    '''
+    def __init__(self, initial_seed):
+        self.initial_seed = initial_seed
+        self.next_seed = None
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+
+    def update_seed(self):
+        '''
+        The first seed is the initial one; the next ones are drawn,
+        with the same number of digits, from the current state.
+        '''
+        if self.next_seed is None:
+            self.next_seed = self.initial_seed
+        else:
+            n = len(self.initial_seed)
+            self.next_seed = self._rng.randint(10 ** (n-1), (10**n) - 1)
+        self._rng.seed(self.next_seed)
+
+    def new_salt(self):
+        with self._lock:
+            self.update_seed()
+            return self._rng.getrandbits(128).to_bytes(16, 'big')
+
+    def copy(self):
+        '''
+        Returns an independent generator continuing the same chain.
+        '''
+        other = SaltGenerator(self.initial_seed)
+        with self._lock:
+            other.next_seed = self.next_seed
+            other._rng.setstate(self._rng.getstate())
+        return other
+
+
 class SaltHelper(metaclass=Singleton):
     '''
     This class offers the methods used for salt management. 
@@ -70,115 +132,359 @@ class SaltHelper(metaclass=Singleton):
     def __init__(self, logger):
         self.SEED_FILE = 'seed0.txt'
         self.logger = logger
-        self.next_seed = None
+        self.seed0 = None
+        self._lock = threading.RLock()
+        self._default = None
         
     def generate_seed(self):
         '''
         Stores a time-based seed in the current directory.
         '''
         self.logger.info('Generating new seed')
-        seed0 = time.time_ns()
+        self.set_seed(str(time.time_ns()))
+
+    def set_seed(self, seed0):
+        '''
+        Stores seed0 in the current directory, e.g. the seed of a
+        restored registry, and uses it from now on.
+        '''
         with open(self.SEED_FILE, 'w+') as f:
-            f.write(str(seed0))
+            f.write(seed0)
+        with self._lock:
+            self.seed0 = seed0
         
     def read_initial_seed(self):
-        with open(self.SEED_FILE, 'r') as f:
-            rst = f.readline()
-        self.logger.info(f'Seed read: {rst}')
-        return rst
+        '''
+        Reads the seed file on the first call only.
+        '''
+        with self._lock:
+            if self.seed0 is None:
+                with open(self.SEED_FILE, 'r') as f:
+                    self.seed0 = f.readline()
+                shared.log_key_material(self.logger, 'Seed read: %s',
+                                        self.seed0)
+            return self.seed0
+
+    def generator(self):
+        '''
+        Returns a new SaltGenerator, e.g. for a Double Ratchet session.
+        '''
+        return SaltGenerator(self.read_initial_seed())
 
-    def update_seed(self):
+    def new_salt(self):
         '''
-        If next_seed is set, returns it; otherwise, it
-        updates the random seed using a pseudo random 
-        number generated by randint.
+        Next salt of the process-wide chain.
         '''
-        ns = self.read_initial_seed()
-        if self.next_seed is None:
-            new_seed = ns
-        else:
-            n = len(ns)
-            range_start = 10 ** (n-1)
-            range_end = (10**n) - 1
-            new_seed = random.randint(range_start, range_end)
-            
-        self.next_seed = new_seed
+        with self._lock:
+            if self._default is None:
+                self._default = self.generator()
+        return self._default.new_salt()
 
-    def seed_salt_generator(self):
-        self.update_seed()
-        random.seed(self.next_seed)
 
-        
-    def new_salt(self):
-        self.seed_salt_generator()
-        rst = ''
-        for i in range(16):
-            cur_rand = random.randint(0,255)
-            rst += chr(cur_rand)
-        return rst.encode('utf-8')
+class KeyPool():
+    '''
+    Bounded reservoir of private keys made by 'generate', refilled by
+    a background thread whenever less than 'low_water' keys are left.
+    get() pops a ready key, or generates one inline if the pool is
+    empty.
+    '''
+    def __init__(self, generate, size=32, low_water=None):
+        self.generate = generate
+        self.size = size
+        self.low_water = size // 2 if low_water is None else low_water
+        self._keys = collections.deque()
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        # seconds from a refill request to the pool being full again
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._refill_since = time.monotonic()
+        self._refiller = threading.Thread(target=self._refill,
+                                          name='key-pool', daemon=True)
+        self._refiller.start()
+
+    def get(self):
+        with self._cond:
+            if self._keys:
+                self.hits += 1
+                key = self._keys.popleft()
+            else:
+                self.misses += 1
+                key = None
+            if len(self._keys) < self.low_water:
+                self._cond.notify()
+        return key if key is not None else self.generate()
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                while len(self._keys) >= self.low_water:
+                    self._cond.wait()
+                self._refill_since = time.monotonic()
+            while True:
+                key = self.generate()
+                with self._cond:
+                    self._keys.append(key)
+                    self.generated += 1
+                    if len(self._keys) >= self.size:
+                        self.last_lag = time.monotonic() - self._refill_since
+                        self.max_lag = max(self.max_lag, self.last_lag)
+                        break
+
+    def stats(self):
+        with self._cond:
+            taken = self.hits + self.misses
+            return {'ready': len(self._keys), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / taken if taken else None,
+                    'generated': self.generated,
+                    'last_refill_lag': self.last_lag,
+                    'max_refill_lag': self.max_lag}
+
+
+class KeyCache():
+    '''
+    Bounded LRU map from encoded public keys to the public key
+    objects decoded from them, so that a key received many times,
+    e.g. the ratchet key of a run of messages, is decoded once.
+    Thread-safe.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, encoded, decode):
+        with self._lock:
+            pk = self._keys.get(encoded)
+            if pk is not None:
+                self._keys.move_to_end(encoded)
+                self.hits += 1
+                return pk
+            self.misses += 1
+        pk = decode(encoded)
+        with self._lock:
+            self._keys[encoded] = pk
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return pk
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._keys), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+class CipherSuite():
+    '''
+    The primitives X3DH and the Double Ratchet are built on: the type
+    of the key pairs and their exchange, the signature of the prekeys,
+    the hash of the KDF and the AEAD of the messages. A node registers
+    the name of its suite in its public info, and both parties of a
+    chat must use the same one.
+    '''
+    name = None
+    HASH = SHA256()
+    AEAD = AESGCM
+    KEY_LEN = 32 # 32 B = 256 bits
+    # whether prekeys are signed by a key other than the identity one
+    SEPARATE_SIGNING_KEY = False
 
+    def gen_key(self):
+        raise NotImplementedError
 
-    
-class KeyHelper(metaclass=Singleton):
+    def gen_signing_key(self):
+        return self.gen_key()
+
+    def exchange(self, private_key, public_key):
+        raise NotImplementedError
+
+    def sign(self, signing_k, data):
+        raise NotImplementedError
+
+    def verify(self, signing_pk, signature, data):
+        '''
+        Raises InvalidSignature if signature does not match.
+        '''
+        raise NotImplementedError
+
+    def serialize_pk(self, pk):
+        raise NotImplementedError
+
+    def deserialize_pk(self, spk):
+        raise NotImplementedError
+
+    def serialize_spk(self, spk):
+        return self.serialize_pk(spk)
+
+    def deserialize_spk(self, sspk):
+        return self.deserialize_pk(sspk)
+
+
+class Secp256k1Suite(CipherSuite):
+    '''
+    ECDH and ECDSA on SECP256K1, with AES-GCM; the identity key also
+    signs the prekey.
+    '''
+    name = 'secp256k1'
+    EC = ec.SECP256K1()
+    SIGN_ALG = ec.ECDSA
+
+    def gen_key(self):
+        return ec.generate_private_key(curve=self.EC,
+                                       backend=openssl.backend)
+
+    def exchange(self, private_key, public_key):
+        return private_key.exchange(ec.ECDH(), public_key)
+
+    def sign(self, signing_k, data):
+        return signing_k.sign(data, self.SIGN_ALG(self.HASH))
+
+    def verify(self, signing_pk, signature, data):
+        signing_pk.verify(signature, data, self.SIGN_ALG(self.HASH))
+
+    def serialize_pk(self, pk):
+        return pk.public_bytes(Encoding.X962, PublicFormat.CompressedPoint)
+
+    def deserialize_pk(self, spk):
+        return ec.EllipticCurvePublicKey.from_encoded_point(self.EC, spk)
+
+
+class X25519Suite(CipherSuite):
+    '''
+    X25519 exchanges, prekeys signed by a separate Ed25519 identity
+    key, ChaCha20-Poly1305 messages.
+    '''
+    name = 'x25519'
+    AEAD = ChaCha20Poly1305
+    SEPARATE_SIGNING_KEY = True
+
+    def gen_key(self):
+        return X25519PrivateKey.generate()
+
+    def gen_signing_key(self):
+        return Ed25519PrivateKey.generate()
+
+    def exchange(self, private_key, public_key):
+        return private_key.exchange(public_key)
+
+    def sign(self, signing_k, data):
+        return signing_k.sign(data)
+
+    def verify(self, signing_pk, signature, data):
+        signing_pk.verify(signature, data)
+
+    def serialize_pk(self, pk):
+        return pk.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+    def deserialize_pk(self, spk):
+        return X25519PublicKey.from_public_bytes(spk)
+
+    def deserialize_spk(self, sspk):
+        return Ed25519PublicKey.from_public_bytes(sspk)
+
+
+SUITES = {s.name: s() for s in [Secp256k1Suite, X25519Suite]}
+# suite of the nodes that do not ask for a specific one
+DEFAULT_SUITE = os.environ.get('SIGNALPY_SUITE', 'secp256k1')
+
+
+class SuiteSingleton(type):
+    '''
+    As Singleton, with one instance per cipher suite name.
+    '''
+    _instances = {}
+    def __call__(cls, logger, suite=None):
+        key = (cls, suite or DEFAULT_SUITE)
+        if key not in cls._instances:
+            cls._instances[key] = super(SuiteSingleton, cls).__call__(
+                logger, key[1])
+        return cls._instances[key]
+
+
+class KeyHelper(metaclass=SuiteSingleton):
     '''
     This class contains all the used crypto tools and performs
-    the main crypto operations.
+    the main crypto operations, with the primitives of one
+    CipherSuite.
     '''
 
-    def __init__(self, logger):
+    def __init__(self, logger, suite=None):
 
-        # eXtended 3ple Diffie Hellman crypto
-        self.X3DH_EXC_ALG = ec.ECDH()
-        self.X3DH_EC = ec.SECP256K1()
-        self.X3DH_SIGN_ALG = ec.ECDSA
+        self.suite = SUITES[suite or DEFAULT_SUITE]
 
         # Double Ratchet crypto
-        self.DR_ENC_ALG = AESGCM
-        self.DR_ENC_KEY_LEN = 32 # 32 B = 256 bits
+        self.DR_ENC_ALG = self.suite.AEAD
+        self.DR_ENC_KEY_LEN = self.suite.KEY_LEN
 
         # shared crypto
         self.BE = openssl.backend
-        self.HASH = SHA256()
+        self.HASH = self.suite.HASH
 
         self.logger = logger
         
         self.sh = SaltHelper(self.logger)
 
+        # fresh private keys, generated off the message path; started
+        # by the first gen_key, so processes not generating keys have
+        # no pool
+        self.key_pool = None
+        self._pool_lock = threading.Lock()
+        # decoded public keys, by encoding
+        self.pk_cache = KeyCache(PK_CACHE_SIZE)
+
         
     def gen_key(self):
-        generated = ec.generate_private_key(
-            curve=self.X3DH_EC, backend=self.BE
-        )
-        self.logger.info(f'Private key generated: {generated}')
+        if KEY_POOL_SIZE > 0:
+            with self._pool_lock:
+                if self.key_pool is None:
+                    self.key_pool = KeyPool(self.suite.gen_key,
+                                            KEY_POOL_SIZE)
+            generated = self.key_pool.get()
+        else:
+            generated = self.suite.gen_key()
+        self.logger.debug('Private key generated: %s', generated)
         return generated
 
+    def gen_signing_key(self):
+        '''
+        Identity signing key: a key of its own if the suite signs with
+        a separate algorithm, None if the identity key signs.
+        '''
+        if self.suite.SEPARATE_SIGNING_KEY:
+            return self.suite.gen_signing_key()
+
+    def key_pool_stats(self):
+        return self.key_pool.stats() if self.key_pool is not None else {}
+
     
     def sign(self, signing_k, signed_pk):
-        self.logger.info(f'Signing pk {signed_pk} with k {signing_k}')
+        self.logger.debug('Signing pk %s with k %s', signed_pk, signing_k)
         return EllipticCurveSignedPublicKey(
             self.logger,
             pk=signed_pk,
-            signature=signing_k.sign(
-                self.serialize_pk(signed_pk),
-                self.X3DH_SIGN_ALG(self.HASH)
-            )
+            signature=self.suite.sign(signing_k,
+                                      self.serialize_pk(signed_pk)),
+            suite=self.suite.name
         )
 
 
     def exchange(self, private_key, public_key):
-        return private_key.exchange(self.X3DH_EXC_ALG, public_key)
+        return self.suite.exchange(private_key, public_key)
     
     
     def verify(self, signing_k, signature, original_data):
         try:
-            signing_k.verify(
-                signature,
-                original_data,
-                self.X3DH_SIGN_ALG(self.HASH)
-            )
-            self.logger.info(f'Verification of signature {signature} successful')
+            self.suite.verify(signing_k, signature, original_data)
+            self.logger.debug('Verification of signature %s successful',
+                              signature)
         except InvalidSignature as e :
-            self.logger.info(f'Verification of signature {signature} failed\n{e}')
+            self.logger.info('Verification of signature %s failed\n%s',
+                             signature, e)
 
 
     def serialize_pk(self, pk):
@@ -187,11 +493,8 @@ class KeyHelper(metaclass=Singleton):
 
         '''
         if pk is not None:
-            self.logger.info(f'Serializing {pk}')
-            return pk.public_bytes(
-                Encoding.X962,
-                PublicFormat.CompressedPoint
-            )
+            self.logger.debug('Serializing %s', pk)
+            return self.suite.serialize_pk(pk)
 
         
     def deserialize_pk(self, spk):
@@ -199,13 +502,24 @@ class KeyHelper(metaclass=Singleton):
         Deserializes the public key of the key pair
         '''
         if spk is not None:
-            self.logger.info(f'Deserializing {spk}')
-            return ec.EllipticCurvePublicKey.\
-                from_encoded_point(self.X3DH_EC, spk)
+            self.logger.debug('Deserializing %s', spk)
+            return self.pk_cache.get(bytes(spk), self.suite.deserialize_pk)
 
+    def serialize_spk(self, spk):
+        if spk is not None:
+            return self.suite.serialize_spk(spk)
 
-    def hkdf(self, k, j=None):
-        cur_salt = self.sh.new_salt()
+    def deserialize_spk(self, sspk):
+        if sspk is not None:
+            return self.suite.deserialize_spk(sspk)
+
+
+    def hkdf(self, k, j=None, salt=None):
+        '''
+        Derives two keys from k; salt is the next salt of the session,
+        by default the next one of the process-wide chain.
+        '''
+        cur_salt = salt if salt is not None else self.sh.new_salt()
         if j is None:
             # asymmetric racheting
             info = b'root'
@@ -237,9 +551,16 @@ class KeyHelper(metaclass=Singleton):
 
     def decrypt(self, dec_key, ct, nonce):
         aesgcm = self.DR_ENC_ALG(dec_key)
-        return aesgcm.decrypt(nonce=nonce,
-                              data=ct,
-                              associated_data=None)
+        try:
+            return aesgcm.decrypt(nonce=nonce,
+                                  data=ct,
+                                  associated_data=None)
+        except TypeError:
+            # ct is a memoryview of the received message, which old
+            # releases of cryptography do not accept
+            return aesgcm.decrypt(nonce=nonce,
+                                  data=bytes(ct),
+                                  associated_data=None)
 
 
 
@@ -252,10 +573,11 @@ class EllipticCurveSignedPublicKey():
     mid-term public keys). 
     '''
     
-    def __init__(self, logger, pk=None, signature=None, serialized_key=None):
+    def __init__(self, logger, pk=None, signature=None, serialized_key=None,
+                 suite=None):
         # mask this variable in order to uniform with the EllipticCurvePublicKey API
         self.logger = logger
-        self.kh = KeyHelper(self.logger)
+        self.kh = KeyHelper(self.logger, suite)
 
         if serialized_key is None:
             self.__public_key = pk
@@ -292,30 +614,38 @@ class NodeInfo():
     It also offers a public keys serializing feature.
     '''
 
-    def __init__(self, tel_numb, logger):
+    def __init__(self, tel_numb, logger, suite=None):
         
         self.logger = logger
 
-        self.kh = KeyHelper(self.logger)
+        self.kh = KeyHelper(self.logger, suite)
+        # name of the CipherSuite of all the keys
+        self.suite = self.kh.suite.name
         
         # telephone number
         self.id = tel_numb
         # X3DH
         # long-term identity private key 
         self.ik = self.kh.gen_key()
+        # long-term identity signing key, if the suite does not sign
+        # with ik
+        self.isk = self.kh.gen_signing_key()
         # mid-term signed private prekey
         self.prek = self.kh.gen_key()
 
         # signing prepk
         self.prepk = self.kh.sign(
-            self.ik,
+            self.isk if self.isk is not None else self.ik,
             self.prek.public_key()
         )
 
         # ephemeral private key
         self.ek = self.kh.gen_key()
+        # one-time ephemeral keys uploaded to the TTP, indexed by their
+        # serialized public key
+        self.epks = {}
 
-        self.logger.info('Keys generated:\n'+str(self))
+        shared.log_key_material(self.logger, 'Keys generated:\n%s', self)
 
 
     def __str__(self):
@@ -327,43 +657,73 @@ class NodeInfo():
         )
 
     
-    def serialize(self, except_for=[]):
+    def serialize(self, except_for=[], epks=None):
         '''
         Serializes all fields of NodeInfo except for the ones in 
-        except_for list.
+        except_for list. epks are the one-time ephemeral public keys
+        to include, all of them by default.
         '''
         data = {
             'id': self.id,
             'ipk': self.kh.serialize_pk(self.ik.public_key()),
             'prepk': self.prepk.serialize(),
-            'epk': self.kh.serialize_pk(self.ek.public_key())
+            'epk': self.kh.serialize_pk(self.ek.public_key()),
+            'epks': list(self.epks) if epks is None else epks,
+            'suite': self.suite
         }
+        if self.isk is not None:
+            data['ispk'] = self.kh.serialize_spk(self.isk.public_key())
 
         for ef in except_for:
             if ef in data:
                 data.pop(ef)
 
-        return pickle.dumps(data)
+        return wire.encode_bundle(data)
 
     
-    def compute_initiator_ms(self, other_party_pub):
+    def gen_epks(self, n):
+        '''
+        Generates n one-time ephemeral keys and returns their
+        serialized public keys.
+        '''
+        new_epks = []
+        for i in range(n):
+            ek = self.kh.gen_key()
+            new_epks.append(self.kh.serialize_pk(ek.public_key()))
+            self.epks[new_epks[-1]] = ek
+        return new_epks
+
+    def take_ek(self, epk):
         '''
-        Computes the master secret for the initiator.
+        Returns the ephemeral private key of the serialized public key
+        epk, forgetting it if it is a one-time key; None if unknown.
+        '''
+        if epk in self.epks:
+            return self.epks.pop(epk)
+        if epk == self.kh.serialize_pk(self.ek.public_key()):
+            return self.ek
+
+    def compute_initiator_ms(self, other_party_pub, ek=None):
+        '''
+        Computes the master secret for the initiator, using the
+        ephemeral key ek (self.ek by default).
         '''
         
         self.logger.info('Computing master-secret for the initiator side')
+        ek = ek if ek is not None else self.ek
         # X3DH
         other_party_pub.verify_prepk()
         ik_prepk = self.kh.exchange(self.ik,
                                     other_party_pub.prepk.public_key())
-        ek_ipk = self.kh.exchange(self.ek,
+        ek_ipk = self.kh.exchange(ek,
                                   other_party_pub.ipk)
-        ek_prepk = self.kh.exchange(self.ek,
+        ek_prepk = self.kh.exchange(ek,
                                     other_party_pub.prepk.public_key())
         
         master_secret = ik_prepk + ek_ipk + ek_prepk
 
-        self.logger.info(f'Master secret computed: {master_secret}')
+        shared.log_key_material(self.logger, 'Master secret computed: %s',
+                                master_secret)
         return master_secret
 
         
@@ -380,7 +740,8 @@ class NodeInfo():
                                     other_party_pub.epk)
 
         master_secret = prek_ipk + ik_epk + prek_epk
-        self.logger.info(f'Master secret computed: {master_secret}')
+        shared.log_key_material(self.logger, 'Master secret computed: %s',
+                                master_secret)
         return master_secret
 
 
@@ -388,8 +749,8 @@ class NodeInfo():
         '''
         Computes a new ephemeral key.
         '''
-        log_info = lambda key_type: \
-            self.logger.info(f'New {key_type} key computed: {self}')
+        log_info = lambda key_type: shared.log_key_material(
+            self.logger, 'New %s key computed: %s', key_type, self)
         
         for k in keys:
             if k == 'ek':
@@ -408,18 +769,55 @@ class NodePublicInfo():
     def __init__(self, serialized_info, logger):
 
         self.logger = logger
+        # replaced by the one of the suite named in serialized_info
         self.kh = KeyHelper(self.logger)
+        self.suite = self.kh.suite.name
 
         # X3DH
         self.id, self.ipk, self.prepk, self.epk = [None] * 4
+        # pool of serialized one-time ephemeral public keys
+        self.epks = []
+        # identity signing public key, if the suite does not sign with
+        # the identity key
+        self.ispk = None
         self.union(serialized_info)
 
         
     def union(self, serialized_info):
-        self.id, self.ipk, self.prepk, self.epk = \
+        self.id, self.ipk, self.prepk, self.epk, self.epks, self.ispk = \
             self.deserialize(serialized_info)
         return self
 
+    def take_epk(self):
+        '''
+        Removes and returns a serialized ephemeral public key, from the
+        one-time pool if not empty, otherwise from the single epk slot;
+        None if there is none.
+        '''
+        if self.epks:
+            return self.epks.pop(0)
+        epk = self.kh.serialize_pk(self.epk)
+        self.epk = None
+        return epk
+
+    @staticmethod
+    def with_epk(serialized_info, epk):
+        '''
+        Returns serialized_info with its epk replaced by the serialized
+        epk, without deserializing its keys.
+        '''
+        data = wire.decode_bundle(serialized_info)
+        data['epk'] = epk
+        return wire.encode_bundle(data)
+
+    @staticmethod
+    def peek_id(serialized_info):
+        '''
+        Returns the id of a serialized bundle without deserializing
+        its keys.
+        '''
+        return wire.decode_bundle(serialized_info)['id']
+
     
     def serialize(self, except_for=[]):
         '''
@@ -430,19 +828,26 @@ class NodePublicInfo():
             'id': self.id,
             'ipk': self.kh.serialize_pk(self.ipk),
             'prepk': self.prepk.serialize(),
-            'epk': self.kh.serialize_pk(self.epk)
+            'epk': self.kh.serialize_pk(self.epk),
+            'epks': list(self.epks),
+            'suite': self.suite
         }
+        if self.ispk is not None:
+            data['ispk'] = self.kh.serialize_spk(self.ispk)
 
         for ef in except_for:
             if ef in data:
                 data.pop(ef)
 
-        return pickle.dumps(data)
+        return wire.encode_bundle(data)
 
     
     def deserialize(self, spks):
-        dic = pickle.loads(spks)
-        rst = [self.id, self.ipk, self.prepk, self.epk]
+        dic = wire.decode_bundle(spks)
+        if dic.get('suite', self.suite) != self.suite:
+            self.suite = dic['suite']
+            self.kh = KeyHelper(self.logger, self.suite)
+        rst = [self.id, self.ipk, self.prepk, self.epk, self.epks, self.ispk]
         for key in dic:
             if key == 'id':
                 rst[0] = dic[key]
@@ -451,17 +856,22 @@ class NodePublicInfo():
             elif key == 'prepk':
                 rst[2] = EllipticCurveSignedPublicKey(
                     self.logger,
-                    serialized_key=dic[key]
+                    serialized_key=dic[key],
+                    suite=self.suite
                 )
             elif key == 'epk':
                 rst[3] = self.kh.deserialize_pk(dic[key])
+            elif key == 'epks':
+                rst[4] = list(dic[key])
+            elif key == 'ispk':
+                rst[5] = self.kh.deserialize_spk(dic[key])
         return tuple(rst)
 
     
     def verify_prepk(self):
         signed_data = self.kh.serialize_pk(self.prepk.public_key())
         self.kh.verify(
-            self.ipk,
+            self.ispk if self.ispk is not None else self.ipk,
             self.prepk.signature,
             signed_data
         )
@@ -479,22 +889,27 @@ class MsgHolder():
     '''
     Transfers the i-th message, the i-th public ratchet 
     key and the j-th symmetric ratchet index used for 
-    deriving the message key, mk_{ij}.
+    deriving the message key, mk_{ij}, together with pn, the number
+    of messages of the previous chain of the sender.
     '''
     
-    def __init__(self, holder, logger):
+    def __init__(self, holder, logger, suite=None):
 
         self.logger = logger
-        self.kh = KeyHelper(self.logger)
+        self.kh = KeyHelper(self.logger, suite)
 
         if type(holder) is dict:
             self.msg = holder['msg']
             self.nonce = holder['nonce']
             self.rchpk = holder['rchpk']
             self.j = holder['j']
+            self.pn = holder.get('pn', 0)
+            # encoding of rchpk, if already known
+            self.rchpk_bytes = holder.get('rchpk_bytes')
         else:
-            self.msg, self.nonce, self.rchpk, self.j = \
+            self.msg, self.nonce, self.rchpk_bytes, self.j, self.pn = \
                 self.deserialize(holder)
+            self.rchpk = self.kh.deserialize_pk(self.rchpk_bytes)
 
             
     def __str__(self):
@@ -502,7 +917,8 @@ class MsgHolder():
                 f'msg: {self.msg}\,'+\
                 f'nonce: {self.nonce}\,'+\
                 f'rchpk: {self.kh.serialize_pk(self.rchpk)}\,'+\
-                f'j: {self.j}\]')
+                f'j: {self.j}\,'+\
+                f'pn: {self.pn}\]')
 
         
     def serialize(self):
@@ -513,51 +929,145 @@ class MsgHolder():
         data = {
             'msg': self.msg,
             'nonce': self.nonce,
-            'rchpk': self.kh.serialize_pk(self.rchpk),
-            'j': self.j
+            'rchpk': self.rchpk_bytes if self.rchpk_bytes is not None \
+                else self.kh.serialize_pk(self.rchpk),
+            'j': self.j,
+            'pn': self.pn
         }
         
-        return pickle.dumps(data)
+        return wire.encode_message(**data)
 
     
     def deserialize(self, msg_holder_ser):
-        dic = pickle.loads(msg_holder_ser)
-        rst = [None] * 4
+        dic = wire.decode_message(msg_holder_ser)
+        rst = [None] * 5
         for key in dic:
             if key == 'msg':
                 rst[0] = dic[key]
             elif key == 'nonce':
                 rst[1] = dic[key]
             elif key == 'rchpk':
-                rst[2] = self.kh.deserialize_pk(dic[key])
+                rst[2] = dic[key]
             elif key == 'j':
                 rst[3] = int(dic[key])
+            elif key == 'pn' and dic[key] is not None:
+                rst[4] = int(dic[key])
         return tuple(rst)
 
         
 #---------------- DR state ---------------------
+class MessageKeyError(ValueError):
+    pass
+
+
+class SkippedKeys():
+    '''
+    Bounded map from (encoded ratchet public key, j) to the message
+    keys derived ahead of an out-of-order message and not used yet.
+    Every key is handed out once; when full, the oldest is evicted.
+    '''
+    def __init__(self, maxsize=2000):
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+        self.stored = 0
+        self.used = 0
+        self.evicted = 0
+
+    def put(self, rchpk_bytes, j, mk):
+        self._keys[(rchpk_bytes, j)] = mk
+        self.stored += 1
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, rchpk_bytes, j):
+        return self._keys.get((rchpk_bytes, j))
+
+    def pop(self, rchpk_bytes, j):
+        mk = self._keys.pop((rchpk_bytes, j), None)
+        if mk is not None:
+            self.used += 1
+        return mk
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def stats(self):
+        return {'size': len(self._keys), 'stored': self.stored,
+                'used': self.used, 'evicted': self.evicted}
+
+
 class RatchetKeys():
+    '''
+    Double Ratchet state of a session. Each party has its own sending
+    chain: ck, j and chain_salts are the ones of mine, op_ck, op_j and
+    op_chain_salts the ones of the other party, which keep going after
+    I open a new sending chain.
+
+    Received messages carry the index j of their message key in the
+    chain of their ratchet key, and pn, the length of the previous
+    chain of the sender. The keys skipped by a message arriving early,
+    including the rest of the previous chain when a new one starts,
+    are kept in a SkippedKeys store, from which the late messages are
+    decrypted: messages can be delivered in any order or twice. The
+    ratchet keys of the other party's earlier chains are remembered,
+    and never ratcheted to again.
+
+    The salts of a chain come from a generator seeded, at the
+    asymmetric step opening it, from the session salts. Both parties
+    open the chains in the same order, and derive the keys of a chain
+    in the order of j, hence they agree on the salts however the
+    messages are delivered.
+
+    Sending and receiving may run on different threads: a sender
+    holds 'lock' from the asymmetric step to reading the fields of
+    the encrypted message, receive holds it throughout.
+    '''
+
+    # written back by receive once a message decrypted; pn and j too
+    # if it opened a new chain
+    _RECEIVING_FIELDS = ('rk', 'salts', 'op_rchpk', 'op_rchpk_bytes',
+                         'op_rchpk_history', 'op_ck', 'op_j',
+                         'op_chain_salts')
     
-    def __init__(self, master_secret, logger):
+    def __init__(self, master_secret, logger, suite=None):
         self.logger = logger
-        self.kh = KeyHelper(self.logger)
+        self.kh = KeyHelper(self.logger, suite)
 
-        # my asymmetric ratchet
+        # my asymmetric ratchet, and the encoding of its public key
         self.rchk = None
-        # other party public ratchet key
+        self.rchpk_bytes = None
+        # other party public ratchet key, and its encoding
         self.op_rchpk = None
+        self.op_rchpk_bytes = None
+        # encodings of the previous ratchet public keys of the other
+        # party
+        self.op_rchpk_history = collections.deque(maxlen=OP_RCHPK_HISTORY)
 
         # symmetric ratchet
         # root key
         self.rk = master_secret
         # number of symmetric ratchet
         self.j = 0
+        # number of messages of my previous sending chain
+        self.pn = 0
         # chaining key
         self.ck = 'None'
         # symmetric message encryption/decryption key
         self.mk = 'None'
-        # number of other party's symmetric ratchet
+        # number of other party's symmetric ratchet, and its chaining
+        # key
         self.op_j = 0
+        self.op_ck = None
+        # salts of this session, and of my and the other party's chain
+        self.salts = SaltHelper(self.logger).generator()
+        self.chain_salts = None
+        self.op_chain_salts = None
+        self.skipped = SkippedKeys(SKIPPED_KEYS_SIZE)
+        self.lock = threading.RLock()
 
         
     def __str__(self):
@@ -572,30 +1082,32 @@ class RatchetKeys():
             f'Symmetric ratchet number: {self.j}\,'+\
             f'Other party\'s symmetric ratchet number: {self.op_j}\,'+\
             f'Chaining key: {self.ck}\,'
+            f'Other party\'s chaining key: {self.op_ck}\,'
             f'Message key: {self.mk}\]'
         )
 
     
-    def is_equal_to_op_rchpk(self, msg_rchpk):
-        ser_op_rchpk = self.kh.serialize_pk(self.op_rchpk) 
-        ser_msg_rchpk = self.kh.serialize_pk(msg_rchpk)
-        self.logger.info(f'{ser_op_rchpk} \n {ser_msg_rchpk}')
-        return ser_op_rchpk == ser_msg_rchpk
+    def is_equal_to_op_rchpk(self, msg_rchpk_bytes):
+        '''
+        Compares the encoded ratchet key of a message with the one of
+        the other party.
+        '''
+        shared.log_key_material(self.logger, '%s \n %s',
+                                self.op_rchpk_bytes, msg_rchpk_bytes)
+        return self.op_rchpk_bytes == msg_rchpk_bytes
         
 
     
-    def _capitalize_first(self, string):
-        return string[0].upper()+string[1:]
-
-    
     def log_info(self, key_type):
-        self.logger.info(f'{self._capitalize_first(key_type)}'+\
-                         f' key updated:\n{self}')
+        shared.log_key_material(self.logger, 'Updated %s key:\n%s',
+                                key_type, self)
 
         
-    def update_key(self, key_type, k):
+    def update_key(self, key_type, k, encoded=None):
         if key_type == 'op_rchpk':
             self.op_rchpk = k
+            self.op_rchpk_bytes = encoded if encoded is not None \
+                else self.kh.serialize_pk(k)
             self.log_info('other party ratchet public')
         if key_type == 'rk':
             self.rk = k
@@ -608,17 +1120,19 @@ class RatchetKeys():
     def compute_new_key(self, key_type):
         if key_type == 'rchk':
             self.rchk = self.kh.gen_key()                
+            self.rchpk_bytes = self.kh.serialize_pk(self.rchk.public_key())
             self.log_info('ratchet')
 
 
     def _log_sym_ratchet(self, ratchet_type):
-        self.logger.info(f'{self._capitalize_first(ratchet_type)} '+\
-                         f'ratchet:\n{self}')
+        shared.log_key_material(self.logger, 'Ratchet step (%s):\n%s',
+                                ratchet_type, self)
             
     
-    def new_asym_rchs(self, my_info, other_party_pub):
+    def new_asym_rchs(self, my_info, other_party_pub, receiving=False):
         '''
-        Computes the current ratchet shared secret.
+        Computes the current ratchet shared secret, opening a new
+        sending chain: the other party's if receiving, otherwise mine.
         '''
         cur_k, cur_pk = None, None
         if self.op_rchpk is None:
@@ -639,21 +1153,111 @@ class RatchetKeys():
                 cur_k = self.rchk
         cur_rk = self.rk + self.kh.exchange(cur_k, cur_pk)
 
-        self.rk, self.ck = self.kh.hkdf(cur_rk)
+        with self.lock:
+            self.rk, ck = self.kh.hkdf(cur_rk, salt=self.salts.new_salt())
+            seed = int.from_bytes(self.salts.new_salt(), 'big')
+            if receiving:
+                self.op_ck, self.op_j = ck, 0
+                self.op_chain_salts = SaltGenerator(str(seed))
+            else:
+                self.ck = ck
+                self.chain_salts = SaltGenerator(str(seed))
         self._log_sym_ratchet('asymmetric')
 
 
     def encrypt(self, msg):
-        self.ck, self.mk = self.kh.hkdf(self.ck)
-        self.j += 1
-        self._log_sym_ratchet('symmetric')
-        return self.kh.encrypt(self.mk, msg)
+        with self.lock:
+            self.ck, self.mk = self.kh.hkdf(self.ck,
+                                            salt=self.chain_salts.new_salt())
+            self.j += 1
+            self._log_sym_ratchet('symmetric')
+            return self.kh.encrypt(self.mk, msg)
+
 
+    def receive(self, mh, my_info):
+        '''
+        Decrypts the MsgHolder mh, ratcheting to its chain if new.
 
-    def decrypt(self, ct, nonce):
-        self.ck, self.mk = self.kh.hkdf(self.ck)
+        The state is changed only once the message decrypted: if no key
+        can be found for it a MessageKeyError is raised, if it does not
+        decrypt the error of the AEAD (InvalidTag), and in both cases
+        the session is left as it was.
+        '''
+        with self.lock:
+            mk = self.skipped.get(mh.rchpk_bytes, mh.j)
+            if mk is not None:
+                pt = self.kh.decrypt(mk, mh.msg, mh.nonce)
+                self.skipped.pop(mh.rchpk_bytes, mh.j)
+                return pt
+            if mh.rchpk_bytes in self.op_rchpk_history:
+                raise MessageKeyError(
+                    f'No key for message {mh.j} of an earlier chain: '
+                    'used or evicted')
+            if mh.rchpk_bytes == self.op_rchpk_bytes and mh.j <= self.op_j:
+                raise MessageKeyError(
+                    f'No key for message {mh.j}: used or evicted')
+
+            trial = self._copy()
+            skipped = []
+            fields = self._RECEIVING_FIELDS
+            if mh.rchpk_bytes != self.op_rchpk_bytes:
+                trial._ratchet(mh, my_info, skipped)
+                fields += ('pn', 'j')
+            trial._skip_to(mh.j - 1, skipped)
+            trial.op_ck, mk = trial._next_op_key()
+            pt = self.kh.decrypt(mk, mh.msg, mh.nonce)
+
+            for name in fields:
+                setattr(self, name, getattr(trial, name))
+            for rchpk_bytes, j, mk in skipped:
+                self.skipped.put(rchpk_bytes, j, mk)
         self._log_sym_ratchet('symmetric')
-        return self.kh.decrypt(self.mk, ct, nonce)
+        return pt
+
+
+    def _copy(self):
+        trial = copy.copy(self)
+        trial.salts = self.salts.copy()
+        for name in ('chain_salts', 'op_chain_salts'):
+            if getattr(self, name) is not None:
+                setattr(trial, name, getattr(self, name).copy())
+        return trial
+
+
+    def _ratchet(self, mh, my_info, skipped):
+        # the rest of the current chain of the other party
+        if self.op_ck is not None and mh.pn is not None:
+            self._skip_to(mh.pn, skipped)
+        if self.op_rchpk_bytes is not None:
+            self.op_rchpk_history = collections.deque(
+                self.op_rchpk_history, maxlen=OP_RCHPK_HISTORY)
+            self.op_rchpk_history.append(self.op_rchpk_bytes)
+        self.update_key('op_rchpk', mh.rchpk, mh.rchpk_bytes)
+        # my next message opens a new sending chain
+        self.pn, self.j = self.j, 0
+        self.new_asym_rchs(my_info, None, receiving=True)
+
+
+    def _next_op_key(self):
+        '''
+        Returns the next chaining key and message key of the other
+        party's chain.
+        '''
+        self.op_j += 1
+        return self.kh.hkdf(self.op_ck, salt=self.op_chain_salts.new_salt())
+
+
+    def _skip_to(self, j, skipped):
+        '''
+        Derives the keys of the other party's chain up to message j,
+        appending them to skipped.
+        '''
+        if j - self.op_j > MAX_SKIP:
+            raise MessageKeyError(
+                f'{j - self.op_j} keys to skip, more than {MAX_SKIP}')
+        while self.op_j < j:
+            self.op_ck, mk = self._next_op_key()
+            skipped.append((self.op_rchpk_bytes, self.op_j, mk))
 
         
 #---------------- testing ----------------------------
@@ -687,7 +1291,7 @@ def prepare_message(ms_a, msg, na, bpub, archk):
         'msg': ct,
         'nonce' : nonce,
         'rchpk' : archk.rchk.public_key(),
-        'j' : 0
+        'j' : archk.j
     }, salt
 
 
@@ -722,14 +1326,132 @@ def test_e2ee():
     mh_des = MsgHolder(mh_ser, al)
    
     brchk = RatchetKeys(ms_b, al)
-    brchk.update_key('op_rchpk', archk.rchk.public_key())
-
-    brk = brchk.new_asym_rchs(nb, apub)
-    pt = brchk.decrypt(mh_des.msg, mh_des.nonce)
+    pt = brchk.receive(mh_des, nb)
     print(pt)
 
 
 #test_e2ee()
+
+
+def chat(sessions, al):
+    '''
+    Returns the functions sending and receiving messages between the
+    sessions, as Node does.
+    '''
+    def send(sender, texts):
+        # as Node.on_message_sent
+        rch_keys, my_info, op_pub = sessions[sender]
+        bodies = []
+        for text in texts:
+            with rch_keys.lock:
+                if rch_keys.j == 0:
+                    rch_keys.compute_new_key('rchk')
+                    rch_keys.new_asym_rchs(my_info, op_pub)
+                ct, nonce = rch_keys.encrypt(text)
+                bodies.append(MsgHolder({
+                    'msg': ct, 'nonce': nonce,
+                    'rchpk': rch_keys.rchk.public_key(),
+                    'rchpk_bytes': rch_keys.rchpk_bytes,
+                    'j': rch_keys.j, 'pn': rch_keys.pn
+                }, al).serialize())
+        return bodies
+
+    def receive(receiver, body):
+        rch_keys, my_info, op_pub = sessions[receiver]
+        try:
+            return rch_keys.receive(MsgHolder(body, al), my_info)\
+                .decode('utf-8')
+        except (MessageKeyError, InvalidTag):
+            return None
+
+    return send, receive
+
+
+def test_out_of_order():
+    '''
+    Reorders, duplicates, corrupts and redelivers messages across
+    chains: every message is decrypted once, the others are refused
+    and the session goes on.
+    '''
+    na, nb, al = set_up()
+    SaltHelper(al).generate_seed()
+    ms_a, apub, ms_b, bpub = test_compute_ms(na, nb, al)
+    sessions = {'A': (RatchetKeys(ms_a, al), na, bpub),
+                'B': (RatchetKeys(ms_b, al), nb, apub)}
+
+    send, receive = chat(sessions, al)
+
+    a = send('A', ['a1', 'a2', 'a3', 'a4'])
+    assert receive('B', a[2]) == 'a3'
+    assert receive('B', a[0]) == 'a1'
+    assert receive('B', a[2]) is None
+    b = send('B', ['b1'])
+    assert receive('A', b[0]) == 'b1'
+    # a new chain: pn tells B that a4 ended the previous one
+    a += send('A', ['a5', 'a6'])
+    assert receive('B', a[5]) == 'a6'
+    assert receive('B', a[0]) is None
+    assert receive('B', a[1]) == 'a2'
+    assert receive('B', a[4]) == 'a5'
+    assert receive('B', a[3]) == 'a4'
+    assert receive('B', a[1]) is None
+    # a corrupted message changes nothing
+    a += send('A', ['a7'])
+    assert receive('B', a[6][:-1] + bytes([a[6][-1] ^ 1])) is None
+    assert receive('B', a[6]) == 'a7'
+    b += send('B', ['b2', 'b3'])
+    assert receive('A', b[2]) == 'b3'
+    assert receive('A', b[0]) is None
+    assert receive('A', b[1]) == 'b2'
+    assert len(sessions['A'][0].skipped) == 0
+    assert len(sessions['B'][0].skipped) == 0
+    print('Out of order delivery: OK')
+
+
+def test_concurrent(n=500):
+    '''
+    Both parties send and receive at the same time, on four threads:
+    every message is decrypted.
+    '''
+    import queue
+    na, nb, al = set_up()
+    SaltHelper(al).generate_seed()
+    ms_a, apub, ms_b, bpub = test_compute_ms(na, nb, al)
+    sessions = {'A': (RatchetKeys(ms_a, al), na, bpub),
+                'B': (RatchetKeys(ms_b, al), nb, apub)}
+    send, receive = chat(sessions, al)
+    inboxes = {'A': queue.Queue(), 'B': queue.Queue()}
+    received = {'A': [], 'B': []}
+
+    def sender(me, other):
+        # B can send once it heard from A, as in a chat
+        while me == 'B' and not received['B'] and threads[0].is_alive():
+            time.sleep(0.001)
+        for i in range(n):
+            inboxes[other].put(send(me, [f'{me}{i}'])[0])
+
+    def receiver(me):
+        for i in range(n):
+            try:
+                body = inboxes[me].get(timeout=10)
+            except queue.Empty:
+                # the sender failed
+                return
+            received[me].append(receive(me, body))
+
+    threads = [threading.Thread(target=sender, args=('A', 'B')),
+               threading.Thread(target=sender, args=('B', 'A')),
+               threading.Thread(target=receiver, args=('A',)),
+               threading.Thread(target=receiver, args=('B',))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert received['B'] == [f'A{i}' for i in range(n)], \
+        received['B'].count(None)
+    assert received['A'] == [f'B{i}' for i in range(n)], \
+        received['A'].count(None)
+    print('Concurrent send and receive: OK')
 #
 #    msg = 
 #    na.rchk.public_key()
@@ -770,3 +1492,9 @@ def test_partial():
 #test_partial()
 
 #print('The end')
+
+
+if __name__ == '__main__':
+    # python keys.py
+    test_out_of_order()
+    test_concurrent()
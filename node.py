@@ -12,33 +12,80 @@ Legend:
     pub - public information (public keys of X3DH and rchpk_1)
 '''
 import pika
+import wire
+import logging
+import threading
+import collections
 import shared
 import keys
 from time import sleep
+from cryptography.exceptions import InvalidTag
+
+# topic exchange carrying the chat messages when routing='exchange';
+# routing keys are '<recipient id>.<sender id>'
+CHAT_EXCHANGE = 'chat'
+
+# one-time ephemeral keys uploaded on registration and on every refill
+EPK_BATCH = 16
+
+# inbox messages kept per sender whose session is not set up yet, and
+# number of such senders
+EARLY_MESSAGES = 64
+EARLY_SENDERS = 64
 
 class Node():
 
-    def __init__(self, name, phone_number, contact_list):
+    def __init__(self, name, phone_number, contact_list, transport=None,
+                 routing='queues', suite=None):
+        '''
+        transport is the shared.Transport used for talking to the
+        broker; by default the process-wide one, which is closed when
+        the last node using it terminates. A transport passed by the
+        caller is left open.
+
+        routing selects how chat messages are addressed: 'queues' uses
+        two queues per conversation ('<sender>_to_<recipient>'),
+        'exchange' a single inbox queue per node bound to
+        CHAT_EXCHANGE, whatever the number of open chats.
+
+        suite is the name of the keys.CipherSuite of the node, by
+        default keys.DEFAULT_SUITE; it can only chat with nodes using
+        the same one.
+        '''
         self.my_name = name
         self.my_cl = contact_list
+        self.routing = routing
+        self.own_transport = transport is None
+        self.transport = transport if transport is not None \
+            else shared.acquire_transport()
+
+        # per peer id: public info, ratchet state and chat logger
+        self.peers = {}
+        self.sessions = {}
+        self.peer_loggers = {}
+        # per sender id: inbox messages arrived before its session
+        self.early = collections.OrderedDict()
+        self.early_lock = threading.Lock()
                 
         shared.deactivate_other_loggers()
 
         self.file_logger = shared.complete_logger(
             f'{self.my_name}_node', True)
         
-        self.my_info = keys.NodeInfo(phone_number, self.file_logger)
+        self.my_info = keys.NodeInfo(phone_number, self.file_logger, suite)
         
         self.cu_logger = shared.chat_logger('you')
-        
+
+        self.transport.declare_queues(self.queue_names())
+        self.my_info.gen_epks(EPK_BATCH)
         self.register()
 
         # threads executing long lasting actions, such as listening on
         # queues or getting the user inputs
         self.helpers = [
-            shared.QueueListener(
+            self.transport.subscribe(
                 f'{self.my_info.id}_rep_init_pub', self.rep_init_public),
-            shared.QueueListener(
+            self.transport.subscribe(
                 f'{self.my_info.id}_rep_resp_pub', self.rep_resp_public),
             # collects the name of the selected user and returns it to
             # self.req_public together with the name of the queue where
@@ -46,6 +93,13 @@ class Node():
             shared.InputThread(
                 f'{self.my_info.id}_req_pub', self.req_public)
         ]
+        if self.routing == 'exchange':
+            # the only queue from which chat messages are received
+            self.transport.bind(self.inbox(), CHAT_EXCHANGE,
+                                f'{self.my_info.id}.#')
+            self.helpers.append(
+                self.transport.subscribe(self.inbox(), self.on_inbox_message)
+            )
 
         # needed for encrypting messages
         self.sh = keys.SaltHelper(self.file_logger)
@@ -76,8 +130,27 @@ class Node():
                              ' to open a chat with: ')
 
         
+    def queue_names(self):
+        '''
+        All the queues this node may use, declared in one batch on
+        start up.
+        '''
+        my_id = self.my_info.id
+        queues = ['register', f'{my_id}_req_pub', f'{my_id}_rep_init_pub',
+                  f'{my_id}_rep_resp_pub', f'{my_id}_update_initiator_epk']
+        if self.routing == 'exchange':
+            return queues + [self.inbox()]
+        for cid in self.my_cl.values():
+            queues += [f'{my_id}_to_{cid}', f'{cid}_to_{my_id}']
+        return queues
+
+
+    def inbox(self):
+        return f'{self.my_info.id}_inbox'
+
+
     def register(self):
-        shared.send_message('register', self.my_info.serialize())
+        self.transport.publish('register', self.my_info.serialize())
         self.file_logger.info('Registration at server successful')
 
         
@@ -98,7 +171,7 @@ class Node():
         
     def start_incoming_chat_helper(self):
         self.helpers.append(
-            shared.QueueListener(
+            self.transport.subscribe(
                 f'{self.my_info.id}_rep_resp_pub', self.rep_resp_public)
         )
         info = 'Device on.'
@@ -108,8 +181,8 @@ class Node():
 
     def req_public(self, inp, queue_name):
         if inp in self.my_cl:
-            self.file_logger.info(f'Sending message on {queue_name}')
-            shared.send_message(queue_name, self.my_cl[inp])
+            self.file_logger.info('Sending message on %s', queue_name)
+            self.transport.publish(queue_name, self.my_cl[inp])
         elif inp == '':
             pass
         # the next two branches simulate the case when a client shutdowns
@@ -129,11 +202,12 @@ class Node():
 
             
     def rep_resp_public(self, ch, method, properties, resp_pub):
-        self.file_logger.debug(resp_pub)
         resp_pub = keys.NodePublicInfo(resp_pub, self.file_logger)
-        self.file_logger.debug(resp_pub)
-        self.ou_logger = shared.chat_logger(self.id2name(resp_pub.id))
-        self.file_logger.info(f'Receiving sender public keys: {resp_pub.id}')
+        shared.log_key_material(self.file_logger, '%s', resp_pub)
+        if not self.same_suite(resp_pub):
+            return
+        self.ou_logger = self.peer_logger(resp_pub.id)
+        self.file_logger.info('Receiving sender public keys: %s', resp_pub.id)
         # start chat where the current user is the receiver and the
         # user whose public keys were received is the sender
         self.start_chat(resp_pub, is_initiator=False)
@@ -141,64 +215,142 @@ class Node():
 
     def rep_init_public(self, ch, method, properties, init_pub):
 
-        if init_pub != b'NotRegisteredError':
-            init_pub = keys.NodePublicInfo(init_pub, self.file_logger)
-            self.ou_logger = shared.chat_logger(self.id2name(init_pub.id))
-            self.file_logger.info(f'Receiving receiver public keys: {init_pub}')
+        # the keys of the receiver and which of our ephemeral keys the
+        # TTP gave to it; an error may tell which key went too
+        used = wire.decode_data(init_pub) \
+            if init_pub != b'NotRegisteredError' else {}
+        if 'error' in used:
+            self.refill_epks(used, self.my_info.take_ek(used['epk']))
+        if used.get('error') == 'NoEphemeralKeyError':
+            self.cu_logger.info('Error: no ephemeral key left at the TTP, '
+                                'please retry')
+            self.file_logger.info('No ephemeral key left at the TTP')
+            return
+        if 'bundle' in used:
+            init_pub = keys.NodePublicInfo(used['bundle'], self.file_logger)
+            if not self.same_suite(init_pub):
+                return
+            self.ou_logger = self.peer_logger(init_pub.id)
+            self.file_logger.info('Receiving receiver public keys: %s',
+                                  init_pub.id)
+            shared.log_key_material(self.file_logger, '%s', init_pub)
             # start chat where the current user is the sender and the
             # user whose public keys were received is the receiver
-            self.start_chat(init_pub, is_initiator=True)
+            self.start_chat(init_pub, is_initiator=True, used=used)
         else:
             self.cu_logger.info('Error: your friend is not registered')
             self.file_logger.info('Number not registered')
 
 
+    def same_suite(self, oth_party_pub):
+        if oth_party_pub.suite == self.my_info.suite:
+            return True
+        self.cu_logger.info(f'Error: {self.id2name(oth_party_pub.id)} '+\
+                            f'uses the {oth_party_pub.suite} cipher suite')
+        self.file_logger.info('Cipher suite mismatch: %s',
+                              oth_party_pub.suite)
+        return False
+
+
+    def peer_logger(self, peer_id):
+        if peer_id not in self.peer_loggers:
+            self.peer_loggers[peer_id] = \
+                shared.chat_logger(self.id2name(peer_id))
+        return self.peer_loggers[peer_id]
+
+
     def stop_contact_sel_helper(self):
         # stops the thread getting the input for contact selection
         for h in self.helpers:
             if type(h) is shared.InputThread:
-                self.file_logger.info(f'Stopping selection thread, publishing on {h.queue}')
+                self.file_logger.info(
+                    'Stopping selection thread, publishing on %s', h.queue)
                 h.stop() 
                 self.helpers.remove(h)
 
 
-    def compute_master_secret(self, oth_party_pub, is_initiator):
-        # computing master secret
+    def compute_master_secret(self, oth_party_pub, is_initiator, used=None):
+        # computing master secret; False if the handshake is refused
         if is_initiator:
+            ek = self.my_info.take_ek(used['epk'])
+            if ek is None:
+                # falling back to self.ek would give a master secret
+                # the responder does not have
+                self.cu_logger.info('Error: unknown ephemeral key, '
+                                    'please retry')
+                self.file_logger.info('Refusing handshake with %s: '
+                                      'unknown ephemeral key',
+                                      oth_party_pub.id)
+                return False
             ms = self.my_info.compute_initiator_ms(
-                oth_party_pub
+                oth_party_pub, ek
             )
 
             # starts the asymmetric ratchet storing the first root
-            # key in self.my_rch_keys
+            # key in self.sessions
 
-            self.my_info.compute_new_key(keys=['ek'])
-            shared.send_message(
-                f'{self.my_info.id}_update_initiator_epk',
-                self.my_info.serialize(['ipk', 'prepk'])
-            )
+            self.refill_epks(used, ek)
 
         else:
             ms = self.my_info.compute_responder_ms(oth_party_pub)
 
         # start asymmetric ratchet
-        self.my_rch_keys = keys.RatchetKeys(ms, self.file_logger)
+        self.sessions[oth_party_pub.id] = \
+            keys.RatchetKeys(ms, self.file_logger, self.my_info.suite)
+        with self.early_lock:
+            # from now on the inbox hands its messages to the session
+            self.peers[oth_party_pub.id] = oth_party_pub
+        return True
 
                 
-    def start_chat(self, oth_party_pub, is_initiator):
+    def refill_epks(self, used, ek):
         '''
-        Initiates the secure chat, allocating input/output handlers
-        and computing the shared master secret.
+        Tops up the ephemeral keys at the TTP once ek, the key the TTP
+        handed out as told by used, has been taken.
         '''
-        self.file_logger.info(f'{is_initiator} Setting X3DH master secret with my keys'+
-                            f' {self.my_info}\nand other party keys {oth_party_pub}')
+        if ek is self.my_info.ek:
+            # the pool was empty and the single ephemeral key was
+            # used: renew it together with the pool
+            self.my_info.compute_new_key(keys=['ek'])
+            self.upload_epks(with_ek=True)
+        elif used['low']:
+            self.upload_epks()
 
-        ms = self.compute_master_secret(oth_party_pub, is_initiator)
+    def upload_epks(self, with_ek=False):
+        '''
+        Refills the pool of one-time ephemeral keys at the TTP.
+        '''
+        except_for = ['ipk', 'prepk'] if with_ek else ['ipk', 'prepk', 'epk']
+        self.transport.publish(
+            f'{self.my_info.id}_update_initiator_epk',
+            self.my_info.serialize(except_for,
+                                   epks=self.my_info.gen_epks(EPK_BATCH))
+        )
+
+    def start_chat(self, oth_party_pub, is_initiator, used=None):
+        '''
+        Initiates the secure chat, allocating input/output handlers
+        and computing the shared master secret. used tells the
+        initiator which of its ephemeral keys the TTP handed out.
+        '''
+        self.file_logger.info('%s Setting X3DH master secret with %s',
+                              is_initiator, oth_party_pub.id)
+        shared.log_key_material(
+            self.file_logger, 'My keys %s\nand other party keys %s',
+            self.my_info, oth_party_pub)
+
+        if not self.compute_master_secret(oth_party_pub, is_initiator,
+                                          used):
+            return
+        self.replay_early(oth_party_pub)
         
         self.stop_contact_sel_helper()
 
         # starts the input thread
-        resp_queue = f"{self.my_info.id}_to_{oth_party_pub.id}"
+        if self.routing == 'exchange':
+            resp_queue = f"{oth_party_pub.id}.{self.my_info.id}"
+        else:
+            resp_queue = f"{self.my_info.id}_to_{oth_party_pub.id}"
         self.helpers.append(
             shared.InputThread(
                 resp_queue,
@@ -207,79 +359,148 @@ class Node():
             )
         )
 
-        # queue from which  the current user gets messages
-        init_queue = f"{oth_party_pub.id}_to_{self.my_info.id}"
-        self.helpers.append(
-            shared.QueueListener(init_queue,
-                                 self.on_message_received,
-                                 extra_args={'op_info': oth_party_pub})
-        )
+        if self.routing != 'exchange':
+            # queue from which  the current user gets messages
+            init_queue = f"{oth_party_pub.id}_to_{self.my_info.id}"
+            self.helpers.append(
+                self.transport.subscribe(
+                    init_queue,
+                    self.on_message_received,
+                    extra_args={'op_info': oth_party_pub})
+            )
         
 
         print(f'Chat with {oth_party_pub.id} initialized. '+\
               'Press ENTER to start.')
 
 
-    def marshal_message(self, msg):
-        ct, nonce = self.my_rch_keys.encrypt(msg)#, cur_salt
+    def marshal_message(self, msg, rch_keys):
+        ct, nonce = rch_keys.encrypt(msg)#, cur_salt
         message = {
             'msg': ct,
             'nonce' : nonce,
-            'rchpk' : self.my_rch_keys.rchk.public_key(),
-            'j' :  self.my_rch_keys.j
+            'rchpk' : rch_keys.rchk.public_key(),
+            'rchpk_bytes' : rch_keys.rchpk_bytes,
+            'j' :  rch_keys.j,
+            'pn' : rch_keys.pn
         }
-        mh = keys.MsgHolder(message, self.file_logger)
-        self.file_logger.debug(f'MessageHolder ready to be sent: \n{mh}')
+        mh = keys.MsgHolder(message, self.file_logger, self.my_info.suite)
+        shared.log_key_material(self.file_logger,
+                                'MessageHolder ready to be sent: \n%s', mh)
         return mh.serialize()
         
         
     def on_message_sent(self, inp, queue_name, op_info):
         # evaluate the keyboard input
         # get the TLS connection parameters
-        cur_sym_ratchet = self.my_rch_keys.j
-        if cur_sym_ratchet == 0:
-            self.asymmetric_ratchet(op_info)
-        # we have computed a symmetric ratchet, hence we increment
-        # the counter
-        
         if inp == 'exit()':
             self.terminate()
             return
-        msg = self.marshal_message(inp)
-
-        self.file_logger.info(f'Sending message to {queue_name}')
+        rch_keys = self.sessions[op_info.id]
+        # a message received meanwhile may open a new chain of the
+        # other party, and reset j: the session is locked from the
+        # asymmetric step to the fields of the message
+        with rch_keys.lock:
+            cur_sym_ratchet = rch_keys.j
+            if cur_sym_ratchet == 0:
+                self.asymmetric_ratchet(op_info)
+            msg = self.marshal_message(inp, rch_keys)
+
+        self.file_logger.info('Sending message to %s', queue_name)
         self.cu_logger.info(inp)
-        shared.send_message(queue_name, msg)
+        if self.routing == 'exchange':
+            self.transport.route(CHAT_EXCHANGE, queue_name, msg)
+        else:
+            self.transport.publish(queue_name, msg)
+        if self.file_logger.isEnabledFor(logging.DEBUG):
+            self.file_logger.debug('Transport: %s', self.transport.stats())
+            self.file_logger.debug('Key pool: %s',
+                                   self.my_info.kh.key_pool_stats())
+            self.file_logger.debug('Public key cache: %s',
+                                   self.my_info.kh.pk_cache.stats())
 
         
-    def on_message_received(self, ch, method, properties, body, op_info):
-        mh = keys.MsgHolder(body, self.file_logger)
-        self.file_logger.debug(f'MessageHolder received: \n{mh}')
+    def on_inbox_message(self, ch, method, properties, body):
+        '''
+        Dispatches a message of the inbox to the session of its sender,
+        taken from the routing key. Messages of a sender whose session
+        is not set up yet (e.g. the first ones of a responder, which
+        may overtake the handshake reply) are kept until it is.
+        '''
+        sender_id = method.routing_key.split('.', 1)[1]
+        with self.early_lock:
+            op_info = self.peers.get(sender_id)
+            if op_info is None:
+                self.keep_early(sender_id, (ch, method, properties, body))
+                return
+        self.on_message_received(ch, method, properties, body, op_info)
+
+    def keep_early(self, sender_id, delivery):
+        '''
+        Keeps a delivery of sender_id until its session exists, within
+        EARLY_MESSAGES per sender and EARLY_SENDERS senders.
+        '''
+        if sender_id not in self.early:
+            if len(self.early) >= EARLY_SENDERS:
+                dropped_id, dropped = self.early.popitem(last=False)
+                self.file_logger.info('Dropping %s messages of unknown %s',
+                                      len(dropped), dropped_id)
+            self.early[sender_id] = collections.deque(maxlen=EARLY_MESSAGES)
+        elif len(self.early[sender_id]) == EARLY_MESSAGES:
+            self.file_logger.info('Dropping message of unknown %s',
+                                  sender_id)
+        self.early[sender_id].append(delivery)
+
+    def replay_early(self, oth_party_pub):
+        '''
+        Hands the inbox messages kept for oth_party_pub to its new
+        session.
+        '''
+        with self.early_lock:
+            early = self.early.pop(oth_party_pub.id, ())
+        for ch, method, properties, body in early:
+            self.on_message_received(ch, method, properties, body,
+                                     oth_party_pub)
 
-        if not self.my_rch_keys.is_equal_to_op_rchpk(mh.rchpk):
-            self.asymmetric_ratchet(op_info, mh.rchpk)
 
-        decrypted_body = self.my_rch_keys.\
-            decrypt(mh.msg, mh.nonce).decode('utf-8')
+    def on_message_received(self, ch, method, properties, body, op_info):
+        rch_keys = self.sessions[op_info.id]
+        mh = keys.MsgHolder(body, self.file_logger, self.my_info.suite)
+        shared.log_key_material(self.file_logger,
+                                'MessageHolder received: \n%s', mh)
+
+        # ratchets if the message opens a new chain; late messages are
+        # decrypted with their skipped keys
+        try:
+            decrypted_body = rch_keys.receive(mh, self.my_info).decode('utf-8')
+        except (keys.MessageKeyError, InvalidTag) as e:
+            # the session is left unchanged
+            self.file_logger.info('Dropping message %s from %s: %r',
+                                  mh.j, op_info.id, e)
+            return
+        if self.file_logger.isEnabledFor(logging.DEBUG):
+            self.file_logger.debug('Skipped keys: %s',
+                                   rch_keys.skipped.stats())
         
         if decrypted_body == 'exit()':
             self.terminate()
             return
         
-        self.ou_logger.info(decrypted_body)
+        self.peer_logger(op_info.id).info(decrypted_body)
 
         
-    def asymmetric_ratchet(self, oth_party_pub, op_new_rchpk=None):
-        if op_new_rchpk is None:
-            # renew its ratchet key
-            self.my_rch_keys.compute_new_key('rchk')
-        else:
-            # renew ratchet key of other party
-            self.my_rch_keys.update_key('op_rchpk', op_new_rchpk)
+    def asymmetric_ratchet(self, oth_party_pub):
+        '''
+        Opens a new sending chain; the chains of the other party are
+        opened by RatchetKeys.receive.
+        '''
+        rch_keys = self.sessions[oth_party_pub.id]
+        # renew its ratchet key
+        rch_keys.compute_new_key('rchk')
 
         # zero the number of symmetric ratchets
-        self.my_rch_keys.update_key('j', 0)
-        self.my_rch_keys.new_asym_rchs(self.my_info, oth_party_pub)
+        rch_keys.update_key('j', 0)
+        rch_keys.new_asym_rchs(self.my_info, oth_party_pub)
 
         
     def terminate(self):
@@ -289,3 +510,6 @@ class Node():
                 shared.simulate_enter()
             else:
                 h.join()
+        # the transport connections keep the process alive
+        if self.own_transport:
+            shared.release_transport(self.transport)
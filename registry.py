@@ -0,0 +1,334 @@
+'''
+Registry of the users known to the Trusted Third Party, indexed by
+their id (mobile number), and its durable store.
+'''
+
+import sqlite3
+import threading
+
+
+class SQLiteStore():
+    '''
+    Keeps the serialized public bundle of every registered user in a
+    SQLite table, so that a restarted TTP gets its users back.
+    Bundles are stored as they are serialized: loading them does not
+    deserialize nor verify any key.
+
+    The pool of one-time ephemeral keys of a user is kept in a table
+    of its own, one row per key, so that handing out a key deletes a
+    row instead of rewriting the bundle.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps writers from blocking the readers; NORMAL syncs at
+        # checkpoints only, which is enough for a registry that nodes
+        # re-populate when they register again
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'id TEXT PRIMARY KEY, bundle BLOB NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS epks ('
+            'id TEXT NOT NULL, epk BLOB NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS epks_id ON epks (id)')
+        self._db.commit()
+
+    def _put(self, user_id, bundle, epks):
+        self._db.execute(
+            'INSERT OR REPLACE INTO users (id, bundle) VALUES (?, ?)',
+            (user_id, bundle)
+        )
+        self._db.execute('DELETE FROM epks WHERE id = ?', (user_id,))
+        self._db.executemany('INSERT INTO epks (id, epk) VALUES (?, ?)',
+                             [(user_id, epk) for epk in epks])
+
+    def put(self, user_id, bundle, epks=()):
+        with self._lock, self._db:
+            self._put(user_id, bundle, epks)
+
+    def put_many(self, items):
+        '''
+        Stores the (id, bundle, epks) triples of items in a single
+        transaction.
+        '''
+        with self._lock, self._db:
+            for user_id, bundle, epks in items:
+                self._put(user_id, bundle, epks)
+
+    def delete_epk(self, user_id, epk):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM epks WHERE id = ? AND epk = ?',
+                             (user_id, epk))
+
+    def delete(self, user_id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            self._db.execute('DELETE FROM epks WHERE id = ?', (user_id,))
+
+    def load(self):
+        '''
+        Returns a dict mapping every stored id to its serialized
+        bundle and the list of its pooled ephemeral keys.
+        '''
+        with self._lock:
+            rst = {user_id: (bundle, []) for user_id, bundle
+                   in self._db.execute('SELECT id, bundle FROM users')}
+            for user_id, epk in self._db.execute(
+                    'SELECT id, epk FROM epks ORDER BY rowid'):
+                if user_id in rst:
+                    rst[user_id][1].append(epk)
+            return rst
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class UserRegistry():
+    '''
+    Maps each registered id to its NodePublicInfo. Lookups, inserts
+    and removals are O(1) and all methods are thread-safe, since the
+    TTP handlers run on several worker threads.
+
+    on_duplicate decides what happens when an already registered id
+    registers again: 'replace' (the default, a node re-generates its
+    keys on every start) or 'reject'.
+
+    With a store, every change is written through to it and the
+    users it holds are restored on creation. Restored users are kept
+    serialized and turned into objects by loader (serialized bundle ->
+    NodePublicInfo) the first time they are looked up. Bundles are
+    stored without their 'epks', which the store keeps apart.
+
+    The serialized bundles handed out by serialized() are cached per
+    user and per except_for variant until the user changes.
+    '''
+
+    def __init__(self, on_duplicate='replace', store=None, loader=None):
+        self.on_duplicate = on_duplicate
+        self.store = store
+        self.loader = loader
+        self._users = {}
+        # restored users not looked up yet: id -> (serialized bundle
+        # without epks, epks)
+        self._bundles = store.load() if store is not None else {}
+        # id -> {sorted except_for tuple: serialized bundle}
+        self._serialized = {}
+        self.hits, self.misses = 0, 0
+        self._lock = threading.RLock()
+
+    def _persist(self, pub_info):
+        self._serialized.pop(pub_info.id, None)
+        if self.store is not None:
+            bundle = pub_info.serialize(except_for=['epks'])
+            self._serialized[pub_info.id] = {('epks',): bundle}
+            self.store.put(pub_info.id, bundle, pub_info.epks)
+
+    def add(self, pub_info):
+        '''
+        Registers pub_info; returns False if it was rejected as a
+        duplicate.
+        '''
+        with self._lock:
+            if pub_info.id in self and self.on_duplicate == 'reject':
+                return False
+            self._bundles.pop(pub_info.id, None)
+            self._users[pub_info.id] = pub_info
+            self._persist(pub_info)
+            return True
+
+    def add_many(self, pub_infos):
+        '''
+        Registers all pub_infos, writing them to the store in one
+        transaction. Returns, for each of them, whether it was
+        registered.
+        '''
+        rst = []
+        added = []
+        with self._lock:
+            for pub_info in pub_infos:
+                if pub_info.id in self and self.on_duplicate == 'reject':
+                    rst.append(False)
+                    continue
+                self._bundles.pop(pub_info.id, None)
+                self._serialized.pop(pub_info.id, None)
+                self._users[pub_info.id] = pub_info
+                added.append(pub_info)
+                rst.append(True)
+            if self.store is not None and added:
+                items = [(p.id, p.serialize(except_for=['epks']), p.epks)
+                         for p in added]
+                for user_id, bundle, epks in items:
+                    self._serialized[user_id] = {('epks',): bundle}
+                self.store.put_many(items)
+        return rst
+
+    def get(self, user_id):
+        '''
+        Returns the NodePublicInfo of user_id, None if not registered.
+        '''
+        with self._lock:
+            pub_info = self._users.get(user_id)
+            if pub_info is None and user_id in self._bundles:
+                bundle, epks = self._bundles.pop(user_id)
+                pub_info = self.loader(bundle)
+                # the store is the truth for the pool: keys handed out
+                # are deleted from it only
+                pub_info.epks = list(epks)
+                self._users[user_id] = pub_info
+            return pub_info
+
+    def serialized(self, user_id, except_for=[]):
+        '''
+        Returns the serialized bundle of user_id without the fields in
+        except_for, None if not registered. The bundle of a restored
+        user without its 'epks' is returned without deserializing it.
+        '''
+        variant = tuple(sorted(except_for))
+        with self._lock:
+            if variant == ('epks',) and user_id in self._bundles:
+                return self._bundles[user_id][0]
+            cached = self._serialized.get(user_id, {}).get(variant)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            pub_info = self.get(user_id)
+            if pub_info is None:
+                return None
+            self.misses += 1
+            bundle = pub_info.serialize(except_for=list(variant))
+            self._serialized.setdefault(user_id, {})[variant] = bundle
+            return bundle
+
+    def update(self, user_id, update_fn):
+        '''
+        Applies update_fn to the NodePublicInfo of user_id while holding
+        the registry lock. Returns the updated info, None if user_id is
+        not registered.
+        '''
+        with self._lock:
+            pub_info = self.get(user_id)
+            if pub_info is not None:
+                update_fn(pub_info)
+                self._persist(pub_info)
+            return pub_info
+
+    def take_epk(self, user_id):
+        '''
+        Takes an ephemeral key of user_id, see NodePublicInfo.take_epk.
+        Returns it with the number of one-time keys left, None if
+        user_id is not registered. A key of the pool is only deleted
+        from the store, the bundle is not written again.
+        '''
+        with self._lock:
+            pub_info = self.get(user_id)
+            if pub_info is None:
+                return None
+            pooled = len(pub_info.epks)
+            epk = pub_info.take_epk()
+            if len(pub_info.epks) < pooled:
+                cached = self._serialized.get(user_id, {})
+                for variant in [v for v in cached if 'epks' not in v]:
+                    del cached[variant]
+                if self.store is not None:
+                    self.store.delete_epk(user_id, epk)
+            else:
+                # the single epk slot was used
+                self._persist(pub_info)
+            return epk, len(pub_info.epks)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._bundles.pop(user_id, None)
+            self._serialized.pop(user_id, None)
+            if self.store is not None:
+                self.store.delete(user_id)
+            return self._users.pop(user_id, None)
+
+    def ids(self):
+        with self._lock:
+            return list(self._users) + list(self._bundles)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._users or user_id in self._bundles
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users) + len(self._bundles)
+
+    def __iter__(self):
+        # iterates over a snapshot, so handlers can keep registering;
+        # restored users are deserialized on the way
+        snapshot = [self.get(user_id) for user_id in self.ids()]
+        return iter([pub for pub in snapshot if pub is not None])
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self), 'cache_hits': self.hits,
+                    'cache_misses': self.misses}
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+
+#---------------- testing ----------------------------
+def test_restore():
+    '''
+    Restores a registry from its store: bundles come back serialized,
+    are loaded on first lookup, and keys taken from the pool stay
+    taken.
+    '''
+    import os
+    import tempfile
+    import keys
+    import shared
+
+    logger = shared.complete_logger('Registry')
+    loaded = []
+
+    def loader(bundle):
+        loaded.append(bundle)
+        return keys.NodePublicInfo(bundle, logger)
+
+    alice = keys.NodeInfo('+358 111 222 333', logger)
+    bob = keys.NodeInfo('+358 222 333 111', logger)
+    epks = alice.gen_epks(4)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'registry.db')
+        users = UserRegistry(store=SQLiteStore(path), loader=loader)
+        users.add(keys.NodePublicInfo(alice.serialize(), logger))
+        users.add_many([keys.NodePublicInfo(bob.serialize(), logger)])
+        bundle = users.serialized(alice.id, except_for=['epks'])
+        taken = [users.take_epk(alice.id) for i in range(2)]
+        assert taken == [(epks[0], 3), (epks[1], 2)], taken
+        users.close()
+
+        users = UserRegistry(store=SQLiteStore(path), loader=loader)
+        assert len(users) == 2 and alice.id in users and bob.id in users
+        # served without deserializing
+        assert users.serialized(alice.id, except_for=['epks']) == bundle
+        assert not loaded
+        pub = users.get(alice.id)
+        assert loaded == [bundle]
+        assert pub.id == alice.id and pub.epks == epks[2:], pub.epks
+        assert users.take_epk(alice.id) == (epks[2], 1)
+        users.close()
+
+        users = UserRegistry(store=SQLiteStore(path), loader=loader)
+        assert users.get(alice.id).epks == epks[3:]
+        assert users.get(bob.id).id == bob.id
+        users.close()
+    print('Registry restore: OK')
+
+
+if __name__ == '__main__':
+    # python registry.py
+    test_restore()
@@ -0,0 +1,119 @@
+'''
+Partitioning of the phone-number space among the shards of a sharded
+Trusted Third Party.
+
+Legend:
+  ring - consistent hash ring mapping ids to shards
+  control - exchange over which shards announce joins and leaves
+'''
+
+import bisect
+import hashlib
+import threading
+
+# topic exchange on which the shards announce ring changes
+CONTROL_EXCHANGE = 'ttp_control'
+
+
+def shard_queue(shard_id, kind):
+    '''
+    Name of the queue of kind 'register', 'handshake' or 'control'
+    consumed only by shard shard_id.
+    '''
+    return f'ttp_shard_{shard_id}_{kind}'
+
+
+class HashRing():
+    '''
+    Consistent hash ring: every shard is placed on the ring at
+    'replicas' points, and an id belongs to the shard owning the first
+    point following the hash of the id. Adding or removing a shard
+    only moves the ids between that shard and its neighbours.
+    '''
+
+    def __init__(self, shard_ids=(), replicas=128):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self._lock = threading.Lock()
+        for s in shard_ids:
+            self.add(s)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(
+            hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big'
+        )
+
+    def add(self, shard_id):
+        '''
+        Returns False if shard_id was already on the ring.
+        '''
+        with self._lock:
+            if shard_id in self._owners.values():
+                return False
+            for r in range(self.replicas):
+                point = self._hash(f'{shard_id}#{r}')
+                bisect.insort(self._points, point)
+                self._owners[point] = shard_id
+            return True
+
+    def remove(self, shard_id):
+        '''
+        Returns False if shard_id was not on the ring.
+        '''
+        with self._lock:
+            points = [p for p, s in self._owners.items() if s == shard_id]
+            for p in points:
+                del self._owners[p]
+                self._points.remove(p)
+            return len(points) > 0
+
+    def owner(self, user_id):
+        with self._lock:
+            if not self._points:
+                return None
+            i = bisect.bisect(self._points, self._hash(user_id))
+            return self._owners[self._points[i % len(self._points)]]
+
+    def shards(self):
+        with self._lock:
+            return sorted(set(self._owners.values()))
+
+
+#---------------- testing ----------------------------
+def test_hash_ring():
+    '''
+    Checks the placement of ids and that adding or removing a shard
+    only moves the ids of that shard.
+    '''
+    ids = [f'+358 {i:07d}' for i in range(10000)]
+    ring = HashRing([0, 1, 2])
+    assert ring.shards() == [0, 1, 2]
+    before = {i: ring.owner(i) for i in ids}
+    # deterministic, and every shard gets a fair share
+    assert before == {i: HashRing([2, 0, 1]).owner(i) for i in ids}
+    for s in ring.shards():
+        share = list(before.values()).count(s) / len(ids)
+        assert 0.2 < share < 0.47, (s, share)
+
+    assert ring.add(3) and not ring.add(3)
+    after = {i: ring.owner(i) for i in ids}
+    moved = [i for i in ids if before[i] != after[i]]
+    assert all(after[i] == 3 for i in moved)
+    assert 0.15 < len(moved) / len(ids) < 0.35, len(moved)
+
+    assert ring.remove(3) and not ring.remove(3)
+    assert {i: ring.owner(i) for i in ids} == before
+    assert ring.remove(1)
+    assert all(ring.owner(i) == before[i] for i in ids if before[i] != 1)
+    assert HashRing().owner(ids[0]) is None
+
+    assert shard_queue(2, 'register') == 'ttp_shard_2_register'
+    assert shard_queue(0, 'handshake') != shard_queue(1, 'handshake')
+    print('Hash ring: OK')
+
+
+if __name__ == '__main__':
+    # python sharding.py
+    test_hash_ring()
@@ -2,15 +2,31 @@ from cryptography.hazmat.primitives.serialization \
     import Encoding, PublicFormat, load_der_public_key
 
 import logging
+import logging.handlers
+import os
+import queue
+import atexit
 import pika
 import ssl
 import threading
 import functools
-from pynput.keyboard import Key, Controller
+import asyncio
+import inspect
+import collections
+import concurrent.futures
+import time
+import weakref
+import re
+from pika.adapters.asyncio_connection import AsyncioConnection
 from time import sleep
 
 
 class QueueListener(threading.Thread):
+    '''
+    Thread consuming one queue through the default transport (see
+    set_transport); it lives until stop() is called. New code should
+    use subscribe() directly, which needs no thread.
+    '''
     def __init__(self,  queue_name,
                  handler_function, logger=None,
                  over_tls=True, extra_args=None,
@@ -20,46 +36,27 @@ class QueueListener(threading.Thread):
         self.queue = queue_name
         self.handler = handler_function
         self.logger = logger
+        # TODO_IFF_TIME: plain connections, the transport decides
         self.over_tls = over_tls
         self.extra_args = extra_args
+        self.sub = None
+        self._subscribed = threading.Event()
         self.start()
 
     def run(self):
-        if self.over_tls:
-            conn_params = get_tls_con_param()
-        else:
-            # TODO_IFF_TIME
-            # conn_params = get_plain_con_param()
-            pass
-
-        with pika.BlockingConnection(conn_params) as self.conn:
-            self.in_ch = self.conn.channel()
-
-            # add extra arguments to the callback, if any
-            if self.extra_args != None:
-                self.handler = functools.partial(
-                    self.handler, **self.extra_args
-                )
-                
-            self.in_ch.queue_declare(self.queue)
-            self.in_ch.basic_consume(
-                queue=self.queue,
-                on_message_callback=self.handler,
-                auto_ack=True
-            )
-            # logger is not None only for the TTP's queueListeners
-            if self.logger is not None:
-                self.logger.info(
-                    f' [*] Waiting for messages on {self.queue}'
-                )
-
-            self.in_ch.start_consuming()
+        # logger is not None only for the TTP's queueListeners
+        self.sub = get_transport().subscribe(
+            self.queue, self.handler, self.logger, self.extra_args
+        )
+        self._subscribed.set()
+        self.sub.join()
             
     def kill(self):
-        self.conn.close()
+        self._subscribed.wait()
+        self.sub.stop()
 
     def stop(self):
-        self.conn.call_later(.5, self.kill)
+        self.kill()
 
 class InputThread(threading.Thread):
     '''
@@ -91,6 +88,9 @@ class InputThread(threading.Thread):
 
 
 def simulate_enter(is_initiator):
+    # imported here since pynput connects to the display on import
+    from pynput.keyboard import Key, Controller
+
     keyboard = Controller()
     if not is_initiator:
         keyboard.press('c')
@@ -117,6 +117,66 @@ def get_broker_cred():
                 cred.append( l[len(si):].strip('\n') )
     return cred
 
+
+class _SessionCachingSSLSocket(ssl.SSLSocket):
+    '''
+    Hands the TLS session of every completed handshake back to its
+    context.
+    '''
+
+    def do_handshake(self, *args, **kwargs):
+        super(_SessionCachingSSLSocket, self).do_handshake(*args, **kwargs)
+        self.context.remember(self)
+
+    def _real_close(self):
+        # TLS 1.3 tickets arrive after the handshake: the session is
+        # read again while it is still available
+        if self._sslobj is not None:
+            self.context.remember(self)
+        super(_SessionCachingSSLSocket, self)._real_close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    '''
+    Client SSLContext which offers the last negotiated TLS session on
+    every new connection, so that reconnects to the broker resume the
+    session instead of running a full handshake.
+    '''
+    sslsocket_class = _SessionCachingSSLSocket
+
+    def remember(self, sslsock):
+        # the socket is kept as well, since its session gets updated
+        # when TLS 1.3 tickets arrive
+        self._last_sock = weakref.ref(sslsock)
+        if sslsock.session is not None:
+            self._session = sslsock.session
+
+    def _resumable_session(self):
+        last_sock = getattr(self, '_last_sock', lambda: None)()
+        if last_sock is not None and last_sock._sslobj is not None:
+            self._session = last_sock.session
+        return getattr(self, '_session', None)
+
+    def wrap_socket(self, sock, server_side=False, *args, **kwargs):
+        if not server_side and kwargs.get('session') is None:
+            session = self._resumable_session()
+            if session is not None:
+                try:
+                    return super(ResumingSSLContext, self).wrap_socket(
+                        sock, server_side, *args,
+                        **dict(kwargs, session=session)
+                    )
+                except (ValueError, ssl.SSLError):
+                    # stale session, fall back to a full handshake
+                    self._session = None
+        return super(ResumingSSLContext, self).wrap_socket(
+            sock, server_side, *args, **kwargs
+        )
+
+
+_tls_con_param = None
+_tls_con_param_lock = threading.Lock()
+
 def get_tls_con_param():
     '''
     Prepares the clients TLS connection parameters for the connection 
@@ -124,39 +184,1669 @@ def get_tls_con_param():
 
     Here we use only one client certificate and authentication credentials,
     many of them should be 
+
+    The parameters, and their SSLContext, are built on first use and
+    shared by all the connections of the process.
     '''
-    creds = get_broker_cred()
-
-    context = ssl.create_default_context(
-        cafile="./certs/ca_certificate.pem")
-    context.load_cert_chain("./certs/client_certificate.pem",
-                            "./certs/client_key.pem")
-    ssl_options = pika.SSLOptions(context, "localhost")
-    creds = pika.credentials.PlainCredentials(*creds)
-    conn_params = pika.ConnectionParameters(port=5671,
-                                            ssl_options=ssl_options,
-                                            credentials=creds
-    )
-    return conn_params
+    global _tls_con_param
+    with _tls_con_param_lock:
+        if _tls_con_param is None:
+            creds = get_broker_cred()
+
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_verify_locations(cafile="./certs/ca_certificate.pem")
+            context.load_cert_chain("./certs/client_certificate.pem",
+                                    "./certs/client_key.pem")
+            ssl_options = pika.SSLOptions(context, "localhost")
+            creds = pika.credentials.PlainCredentials(*creds)
+            _tls_con_param = pika.ConnectionParameters(
+                port=5671,
+                ssl_options=ssl_options,
+                credentials=creds
+            )
+        return _tls_con_param
 
 def is_over_tls(conn_params):
     return conn_params.port == 5671
 
-def send_message(queue_name, body, conn_params=get_tls_con_param()):
+class QueueTopology():
     '''
-    Sends a message with payload specified by 'body' to queue 'queue_name'
-    with plain or tls connection parameters. By default tls is used
+    Remembers the queues, exchanges and bindings already declared,
+    so that each of them costs a broker round trip only the first
+    time. It is used by the thread owning the connection only, but
+    the 'declared' set can be shared by the topologies of several
+    connections to the same broker: an entry is added only once the
+    broker confirmed it.
     '''
-    conn = pika.BlockingConnection(conn_params)
-    out_ch = conn.channel()
 
-    out_ch.queue_declare(queue_name)
-    out_ch.basic_publish("", queue_name, body)
+    def __init__(self, declared=None):
+        self.declared = declared if declared is not None else set()
+
+    def declare_queue(self, ch, queue_name):
+        if ('queue', queue_name) not in self.declared:
+            ch.queue_declare(queue_name)
+            self.declared.add(('queue', queue_name))
+
+    def declare_exchange(self, ch, exchange, exchange_type='direct'):
+        if ('exchange', exchange) not in self.declared:
+            ch.exchange_declare(exchange, exchange_type)
+            self.declared.add(('exchange', exchange))
+
+    def bind(self, ch, queue_name, exchange, routing_key):
+        key = ('binding', queue_name, exchange, routing_key)
+        if key not in self.declared:
+            ch.queue_bind(queue_name, exchange, routing_key)
+            self.declared.add(key)
+
+    def declare_queues(self, ch, queue_names):
+        '''
+        Declares all the new queues in a single round trip: all but the
+        last one are sent without waiting for the reply, the last one
+        waits and thus acts as a barrier. A failing declaration closes
+        the channel, which is reported by the barrier.
+        '''
+        new = [q for q in dict.fromkeys(queue_names)
+               if ('queue', q) not in self.declared]
+        if not new:
+            return
+        for q in new[:-1]:
+            # no callback means nowait for pika's asynchronous channel
+            ch._impl.queue_declare(q)
+        ch.queue_declare(new[-1])
+        self.declared.update(('queue', q) for q in new)
+
+
+class _PooledConnection():
+    '''
+    Entry of a PublisherPool: a BlockingConnection, the channel used
+    for plain publishes and, once the first batch is sent, a second
+    channel in publisher confirm mode.
+    '''
+
+    def __init__(self, conn_params, declared=None):
+        self.conn = pika.BlockingConnection(conn_params)
+        self.ch = self.conn.channel()
+        self.confirm_ch = None
+        self.topology = QueueTopology(declared)
+
+        # delivery tag of the next publish on confirm_ch
+        self.next_tag = 1
+        # delivery tag -> index in the current batch
+        self.unconfirmed = collections.OrderedDict()
+        # indexes of the current batch acked by the broker
+        self.acked = set()
+
+    def is_usable(self):
+        return self.conn.is_open and self.ch.is_open
+
+    def close(self):
+        if self.conn.is_open:
+            self.conn.close()
+
+    def _open_confirm_channel(self):
+        # BlockingChannel waits for a confirm after every publish, hence
+        # the underlying asynchronous channel is driven directly
+        self.confirm_ch = self.conn.channel()
+        selected = []
+        self.confirm_ch._impl.confirm_delivery(
+            self._on_confirm, callback=selected.append
+        )
+        while not selected:
+            self.conn.process_data_events(time_limit=1)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            while self.unconfirmed:
+                tag = next(iter(self.unconfirmed))
+                if tag > method.delivery_tag:
+                    break
+                i = self.unconfirmed.pop(tag)
+                if acked:
+                    self.acked.add(i)
+        elif method.delivery_tag in self.unconfirmed:
+            i = self.unconfirmed.pop(method.delivery_tag)
+            if acked:
+                self.acked.add(i)
+
+    def new_batch(self):
+        self.unconfirmed.clear()
+        self.acked = set()
+
+    def publish_confirmed(self, queue_name, bodies, timeout):
+        '''
+        Pipelines all the bodies and then waits, at most 'timeout'
+        seconds, for the broker to confirm them.
+        '''
+        if self.confirm_ch is None or not self.confirm_ch.is_open:
+            self.next_tag = 1
+            self._open_confirm_channel()
+
+        impl = self.confirm_ch._impl
+        for i, body in enumerate(bodies):
+            impl.basic_publish("", queue_name, body)
+            self.unconfirmed[self.next_tag] = i
+            self.next_tag += 1
+
+        deadline = time.monotonic() + timeout
+        while self.unconfirmed:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            self.conn.process_data_events(time_limit=left)
+
+    def batch_failures(self, size):
+        '''
+        Indexes of the current batch of 'size' bodies which were not
+        acked: nacked, not confirmed or never published.
+        '''
+        return sorted(set(range(size)) - self.acked)
+
+
+class PublisherPool():
+    '''
+    Thread-safe pool of long-lived publishing connections.
+
+    Each pooled entry is a BlockingConnection with its channels.
+    A BlockingConnection must not be shared by two threads at the
+    same time, hence every publisher checks one entry out, uses it and
+    gives it back. At most 'size' connections are opened; when all of
+    them are busy the caller waits for one to be released.
+
+    The entries share the set of declared queues, exchanges and
+    bindings ('declared'), which a ConsumerHub on the same broker
+    can use as well.
+    '''
+
+    def __init__(self, conn_params, size=4):
+        self.conn_params = conn_params
+        self.size = size
+        self.declared = set()
+
+        self._idle = []
+        self._cond = threading.Condition()
+        self._opened = 0
+
+        # statistics
+        self.connections_created = 0
+        self.reuses = 0
+        self.publishes = 0
+        self.batches = 0
+        self.batch_failures = 0
+
+    def _discard(self, entry):
+        try:
+            entry.close()
+        except pika.exceptions.AMQPError:
+            pass
+        # the broker may have been restarted: declare everything again
+        self.declared.clear()
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    def acquire(self):
+        '''
+        Returns an open _PooledConnection, reusing an idle one when
+        possible.
+        '''
+        with self._cond:
+            while True:
+                while self._idle:
+                    entry = self._idle.pop()
+                    if entry.is_usable():
+                        self.reuses += 1
+                        return entry
+                    # the broker closed it (e.g. missed heartbeats)
+                    self._opened -= 1
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                self._cond.wait()
+
+        try:
+            entry = _PooledConnection(self.conn_params, self.declared)
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.connections_created += 1
+        return entry
+
+    def release(self, entry):
+        if not entry.is_usable():
+            self._discard(entry)
+            return
+        # let the connection process heartbeats and pending frames
+        # before parking it
+        try:
+            entry.conn.process_data_events(0)
+        except pika.exceptions.AMQPError:
+            self._discard(entry)
+            return
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def publish(self, queue_name, body, retries=1):
+        '''
+        Publishes 'body' on 'queue_name'. If the pooled connection
+        turns out to be broken, it is dropped and the publish is retried
+        on a fresh one.
+        '''
+        while True:
+            entry = self.acquire()
+            try:
+                entry.topology.declare_queue(entry.ch, queue_name)
+                entry.ch.basic_publish("", queue_name, body)
+            except pika.exceptions.AMQPError:
+                self._discard(entry)
+                if retries <= 0:
+                    raise
+                retries -= 1
+                continue
+            self.release(entry)
+            with self._cond:
+                self.publishes += 1
+            return
+
+    def publish_batch(self, queue_name, bodies, timeout=10):
+        '''
+        Publishes all 'bodies' on 'queue_name' with a single wait for
+        the broker's publisher confirms. Returns the indexes of the
+        bodies which were not confirmed; they may be published again.
+        '''
+        bodies = list(bodies)
+        entry = self.acquire()
+        entry.new_batch()
+        try:
+            entry.topology.declare_queue(entry.ch, queue_name)
+            entry.publish_confirmed(queue_name, bodies, timeout)
+        except pika.exceptions.AMQPError:
+            # whatever was not acked before the failure is lost
+            failed = entry.batch_failures(len(bodies))
+            self._discard(entry)
+        else:
+            failed = entry.batch_failures(len(bodies))
+            self.release(entry)
+
+        with self._cond:
+            self.batches += 1
+            self.publishes += len(bodies) - len(failed)
+            self.batch_failures += len(failed)
+        return failed
+
+    def route(self, exchange, routing_key, body, exchange_type='topic'):
+        '''
+        Publishes 'body' on 'exchange' with 'routing_key'.
+        '''
+        entry = self.acquire()
+        try:
+            entry.topology.declare_exchange(entry.ch, exchange, exchange_type)
+            entry.ch.basic_publish(exchange, routing_key, body)
+        except pika.exceptions.AMQPError:
+            self._discard(entry)
+            raise
+        self.release(entry)
+        with self._cond:
+            self.publishes += 1
+
+    def bind(self, queue_name, exchange, routing_key, exchange_type='topic'):
+        '''
+        Declares 'queue_name' and 'exchange' and binds them.
+        '''
+        entry = self.acquire()
+        try:
+            entry.topology.declare_exchange(entry.ch, exchange, exchange_type)
+            entry.topology.declare_queue(entry.ch, queue_name)
+            entry.topology.bind(entry.ch, queue_name, exchange, routing_key)
+        except pika.exceptions.AMQPError:
+            self._discard(entry)
+            raise
+        self.release(entry)
+
+    def declare_queues(self, queue_names):
+        '''
+        Declares all 'queue_names' in one batch.
+        '''
+        entry = self.acquire()
+        try:
+            entry.topology.declare_queues(entry.ch, queue_names)
+        except pika.exceptions.AMQPError:
+            self._discard(entry)
+            raise
+        self.release(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'open_connections': self._opened,
+                'idle_connections': len(self._idle),
+                'connections_created': self.connections_created,
+                'reuses': self.reuses,
+                'publishes': self.publishes,
+                'batches': self.batches,
+                'batch_failures': self.batch_failures
+            }
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._discard(entry)
+
+
+# one pool per set of connection parameters
+_publisher_pools = []
+_publisher_pools_lock = threading.Lock()
+
+def get_publisher_pool(conn_params):
+    '''
+    Returns the process-wide publisher pool for 'conn_params',
+    creating it on first use.
+    '''
+    with _publisher_pools_lock:
+        for params, pool in _publisher_pools:
+            if params is conn_params or params == conn_params:
+                return pool
+        pool = PublisherPool(conn_params)
+        _publisher_pools.append((conn_params, pool))
+        return pool
+
+def publisher_stats():
+    '''
+    Returns the statistics of all the publisher pools in use.
+    '''
+    with _publisher_pools_lock:
+        pools = [pool for _, pool in _publisher_pools]
+    return [pool.stats() for pool in pools]
+
+def send_message(queue_name, body, conn_params=None):
+    '''
+    Sends a message with payload specified by 'body' to queue 'queue_name'
+    with plain or tls connection parameters. By default tls is used.
+    Connections are taken from a shared PublisherPool, so no handshake
+    happens once the pool is warm.
+    '''
+    if conn_params is None:
+        get_transport().publish(queue_name, body)
+        return
+    get_publisher_pool(conn_params).publish(queue_name, body)
     if not is_over_tls(conn_params):
         # this is run when the secure signal
         # connection has been initialized
         print('[you]'+ body)
+
+def send_messages(queue_name, bodies, conn_params=None, timeout=10):
+    '''
+    Sends many messages to queue 'queue_name' on one channel, waiting
+    once for the publisher confirms of the whole batch. Returns the
+    indexes of the bodies that the broker did not confirm.
+    '''
+    if conn_params is None:
+        return get_transport().publish_batch(queue_name, bodies)
+    return get_publisher_pool(conn_params).publish_batch(
+        queue_name, bodies, timeout
+    )
+    
+    
+class Subscription():
+    '''
+    Handle of a queue consumed through a ConsumerHub or a Transport.
+    It offers the same stop/join API of QueueListener, so that callers
+    can keep them in the same helper lists.
+    '''
+
+    def __init__(self, owner, queue_name, handler_function, logger=None):
+        self.owner = owner
+        self.queue = queue_name
+        self.handler = handler_function
+        self.logger = logger
+        self.consumer_tag = None
+
+        # deliveries waiting for a worker; they are handled one at a
+        # time to preserve the per-queue ordering
+        self._pending = collections.deque()
+        self._running = False
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def stop(self):
+        self.owner.unsubscribe(self.queue)
+
+    def join(self, timeout=None):
+        self._cancelled.wait(timeout)
+
+
+class TokenBucket():
+    '''
+    Admits on average 'rate' events per second, with bursts of up to
+    'burst' events. Thread-safe.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, now=None):
+        '''
+        Consumes a token; returns False if none is available.
+        '''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AckBatcher():
+    '''
+    Acknowledges the deliveries of one channel in batches.
+
+    Handlers may complete out of order: the completed deliveries below
+    the oldest one still being handled are acked by a single basic_ack
+    with multiple=True, the ones above it one by one, so that a slow
+    handler does not hold back the acks of the later deliveries. Acks
+    are sent every 'every' completions or 'interval' seconds,
+    whichever comes first.
+    A failed delivery is rejected at once: it is requeued the first
+    time and dropped if it was already redelivered.
+
+    It must be used only by the thread (or event loop) owning 'ch'.
+    '''
+
+    def __init__(self, ch, every=32, interval=0.2):
+        self.ch = ch
+        self.every = every
+        self.interval = interval
+
+        # delivery tags being handled, in delivery order
+        self._outstanding = collections.OrderedDict()
+        # completed delivery tags waiting for the ack
+        self._completed = []
+        self._last_flush = time.monotonic()
+
+        self.acks_sent = 0
+        self.acked = 0
+        self.rejected = 0
+
+    def delivered(self, delivery_tag):
+        self._outstanding[delivery_tag] = None
+
+    def completed(self, delivery_tag, ok, redelivered=False):
+        self._outstanding.pop(delivery_tag, None)
+        if ok:
+            self._completed.append(delivery_tag)
+            if len(self._completed) >= self.every:
+                self.flush()
+        elif self.ch.is_open:
+            self.ch.basic_nack(delivery_tag, multiple=False,
+                               requeue=not redelivered)
+            self.rejected += 1
+
+    def requeue(self, delivery_tag):
+        '''
+        Gives back a delivery that will not be handled.
+        '''
+        self._outstanding.pop(delivery_tag, None)
+        if self.ch.is_open:
+            self.ch.basic_nack(delivery_tag, multiple=False, requeue=True)
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._completed or not self.ch.is_open:
+            return
+        if self._outstanding:
+            limit = next(iter(self._outstanding))
+            run = [t for t in self._completed if t < limit]
+            rest = [t for t in self._completed if t > limit]
+        else:
+            run, rest = self._completed, []
+        if run:
+            self.ch.basic_ack(max(run), multiple=True)
+            self.acks_sent += 1
+        # multiple=True would also ack the deliveries still handled
+        for tag in rest:
+            self.ch.basic_ack(tag, multiple=False)
+        self.acks_sent += len(rest)
+        self.acked += len(self._completed)
+        self._completed = []
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._outstanding),
+            'acks_sent': self.acks_sent,
+            'acked': self.acked,
+            'rejected': self.rejected
+        }
+
+
+class _HubConnection(threading.Thread):
+    '''
+    Owns one BlockingConnection of a ConsumerHub and the channel on
+    which all its consumers live. Every channel operation runs on this
+    thread; other threads schedule them with call().
+
+    If the connection cannot be opened, or is lost, the error is kept
+    and raised by every later call().
+    '''
+
+    def __init__(self, hub, conn_params, name):
+        super(_HubConnection, self).__init__(name=name)
+        self.hub = hub
+        self.conn_params = conn_params
+        self.conn = None
+        self.ch = None
+        self.topology = QueueTopology(hub.declared)
+        self.batcher = None
+        self.stopped = False
+        self.error = None
+        self.ready = threading.Event()
+        self.start()
+
+    def run(self):
+        try:
+            self._serve()
+        except Exception as e:
+            self.error = e
+            self.hub.logger.error('%s failed: %r', self.name, e)
+        finally:
+            # callers waiting for the connection must not hang
+            self.ready.set()
+
+    def _serve(self):
+        with pika.BlockingConnection(self.conn_params) as self.conn:
+            self.ch = self.conn.channel()
+            # bounds the unacked deliveries buffered by this client,
+            # per consumer and for the whole channel
+            self.ch.basic_qos(prefetch_count=self.hub.prefetch)
+            self.ch.basic_qos(prefetch_count=self.hub.max_in_flight,
+                              global_qos=True)
+            self.batcher = AckBatcher(self.ch, self.hub.ack_every,
+                                      self.hub.ack_interval)
+            self.ready.set()
+            while not self.stopped:
+                self.conn.process_data_events(
+                    time_limit=self.hub.ack_interval
+                )
+                self.batcher.flush_if_due()
+            self.batcher.flush()
+
+    def call(self, callback):
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        self.conn.add_callback_threadsafe(callback)
+
+    def start_consume(self, sub):
+        self.topology.declare_queue(self.ch, sub.queue)
+        sub.consumer_tag = self.ch.basic_consume(
+            queue=sub.queue,
+            on_message_callback=functools.partial(self.on_delivery, sub)
+        )
+        if sub.logger is not None:
+            sub.logger.info(f' [*] Waiting for messages on {sub.queue}')
+
+    def on_delivery(self, sub, ch, method, properties, body):
+        self.batcher.delivered(method.delivery_tag)
+        if not self.hub.dispatch(sub, ch, method, properties, body):
+            # workers overloaded: the broker keeps it for later
+            self.batcher.requeue(method.delivery_tag)
+
+    def completed(self, method, ok):
+        '''
+        Called by the workers once a handler returned.
+        '''
+        try:
+            self.call(functools.partial(
+                self.batcher.completed, method.delivery_tag, ok,
+                method.redelivered
+            ))
+        except pika.exceptions.AMQPError:
+            # connection gone: the broker redelivers the message
+            pass
+
+    def stop_consume(self, sub):
+        if sub.consumer_tag is not None:
+            # deliveries not yet handed to the hub are requeued by pika
+            self.ch.basic_cancel(sub.consumer_tag)
+        sub._cancelled.set()
+
+    def stop(self):
+        self.stopped = True
+
+
+class OrderedDispatcher():
+    '''
+    Runs the handlers of Subscriptions on a pool of 'workers' threads.
+    Deliveries of the same Subscription are handled in order, one at
+    a time; different Subscriptions are handled in parallel.
+
+    The handoff between the consumer and the workers is bounded: when
+    'capacity' deliveries are already waiting, dispatch() refuses the
+    new one and counts it as rejected, so that the caller can give it
+    back to the broker. Queue depth and waiting times are tracked.
+    '''
+
+    def __init__(self, workers, name, logger, on_done=None, capacity=None):
+        self.logger = logger
+        # on_done(sub, delivery, ok) is called after each handler
+        self.on_done = on_done
+        self.capacity = capacity
+        self._workers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+
+        # statistics
+        self._stats_lock = threading.Lock()
+        self.depth = 0
+        self.max_depth = 0
+        self.handled = 0
+        self.rejected = 0
+        # deliveries taken off the queue, i.e. with a recorded wait
+        self.dequeued = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def dispatch(self, sub, delivery):
+        '''
+        Queues 'delivery' for 'sub'; returns False if the queue is full.
+        '''
+        with self._stats_lock:
+            if self.capacity is not None and self.depth >= self.capacity:
+                self.rejected += 1
+                return False
+            self.depth += 1
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+
+        with sub._lock:
+            sub._pending.append((time.monotonic(), delivery))
+            if sub._running:
+                return True
+            sub._running = True
+        self._submit(sub)
+        return True
+
+    def _submit(self, sub):
+        try:
+            self._workers.submit(self._drain, sub)
+        except RuntimeError:
+            # the dispatcher has been closed
+            pass
+
+    def _drain(self, sub, batch=16):
+        for _ in range(batch):
+            with sub._lock:
+                if not sub._pending:
+                    sub._running = False
+                    return
+                queued_at, delivery = sub._pending.popleft()
+
+            waited = time.monotonic() - queued_at
+            with self._stats_lock:
+                self.depth -= 1
+                self.dequeued += 1
+                self.total_wait += waited
+                if waited > self.max_wait:
+                    self.max_wait = waited
+
+            ok = True
+            try:
+                sub.handler(*delivery)
+            except Exception:
+                ok = False
+                self.logger.exception(f'Handler of {sub.queue} failed')
+            with self._stats_lock:
+                self.handled += 1
+            if self.on_done is not None:
+                self.on_done(sub, delivery, ok)
+        # give the other queues a chance before going on
+        self._submit(sub)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'capacity': self.capacity,
+                'handled': self.handled,
+                'rejected': self.rejected,
+                'avg_wait': self.total_wait / self.dequeued
+                            if self.dequeued else 0.,
+                'max_wait': self.max_wait
+            }
+
+    def close(self):
+        # close() may be called by a handler, hence it must not wait
+        # for the workers
+        self._workers.shutdown(wait=False)
+
+
+class ConsumerHub():
+    '''
+    Consumes any number of queues over a few connections.
+
+    Queues are spread over 'connections' BlockingConnections and
+    consumed on a single channel each. Deliveries are handed to a
+    pool of 'workers' threads; deliveries of the same queue are
+    handled in order, one at a time.
+
+    At most 'prefetch' unacked deliveries per consumer are pushed by
+    the broker. A delivery is acknowledged only after its handler
+    returned, in batches (see AckBatcher), so a crash loses nothing.
+
+    Backpressure: each channel also has a channel-wide limit of
+    'max_in_flight' unacked deliveries, so the broker stops pushing as
+    soon as the workers fall behind. The handoff queue is bounded by
+    the same amount; should it overflow anyway, the delivery is
+    requeued and counted as rejected (see stats()).
+
+    'declared' is the set of the queues already declared, shared with
+    the publishers (see QueueTopology): consuming one of them takes no
+    queue_declare round trip.
+    '''
+
+    def __init__(self, conn_params, connections=1, workers=8,
+                 prefetch=64, ack_every=32, ack_interval=0.2,
+                 max_in_flight=256, declared=None):
+        self.logger = logging.getLogger('ConsumerHub')
+        self.declared = declared if declared is not None else set()
+        self.prefetch = prefetch
+        self.max_in_flight = max_in_flight
+        self.ack_every = ack_every
+        self.ack_interval = ack_interval
+        self._subs = {}
+        self._lock = threading.Lock()
+        self.dispatcher = OrderedDispatcher(
+            workers, 'consumer-hub-worker', self.logger, self._handled,
+            capacity=max_in_flight * connections
+        )
+        self._conns = [
+            _HubConnection(self, conn_params, f'consumer-hub-{i}')
+            for i in range(connections)
+        ]
+
+    def _conn_for(self, queue_name):
+        return self._conns[hash(queue_name) % len(self._conns)]
+
+    def is_subscribed(self, queue_name):
+        with self._lock:
+            return queue_name in self._subs
+
+    def subscribe(self, queue_name, handler_function, logger=None,
+                  extra_args=None):
+        '''
+        Starts consuming 'queue_name'. Subscribing twice to the same
+        queue returns the existing Subscription.
+        '''
+        # add extra arguments to the callback, if any
+        if extra_args != None:
+            handler_function = functools.partial(
+                handler_function, **extra_args
+            )
+
+        with self._lock:
+            if queue_name in self._subs:
+                return self._subs[queue_name]
+            sub = Subscription(self, queue_name, handler_function, logger)
+            self._subs[queue_name] = sub
+
+        hconn = self._conn_for(queue_name)
+        hconn.call(functools.partial(hconn.start_consume, sub))
+        return sub
+
+    def unsubscribe(self, queue_name):
+        with self._lock:
+            sub = self._subs.pop(queue_name, None)
+        if sub is None:
+            return
+        hconn = self._conn_for(queue_name)
+        hconn.call(functools.partial(hconn.stop_consume, sub))
+
+    def dispatch(self, sub, ch, method, properties, body):
+        '''
+        Called on the connection thread for every delivery; returns
+        False if the delivery could not be queued.
+        '''
+        return self.dispatcher.dispatch(sub, (ch, method, properties, body))
+
+    def _handled(self, sub, delivery, ok):
+        self._conn_for(sub.queue).completed(delivery[1], ok)
+
+    def stats(self):
+        return {
+            'work_queue': self.dispatcher.stats(),
+            'acks': [hconn.batcher.stats() for hconn in self._conns
+                     if hconn.batcher is not None]
+        }
+
+    def close(self):
+        with self._lock:
+            queues = list(self._subs)
+        for q in queues:
+            try:
+                self.unsubscribe(q)
+            except Exception:
+                # its connection is gone, and the consumer with it
+                pass
+        for hconn in self._conns:
+            try:
+                hconn.call(hconn.stop)
+            except Exception:
+                pass
+        for hconn in self._conns:
+            hconn.join()
+        self.dispatcher.close()
+
+
+_consumer_hub = None
+_consumer_hub_lock = threading.Lock()
+
+def get_consumer_hub():
+    '''
+    Returns the process-wide ConsumerHub, connected over TLS.
+    '''
+    global _consumer_hub
+    with _consumer_hub_lock:
+        if _consumer_hub is None:
+            conn_params = get_tls_con_param()
+            _consumer_hub = ConsumerHub(
+                conn_params,
+                declared=get_publisher_pool(conn_params).declared
+            )
+        return _consumer_hub
+
+def subscribe(queue_name, handler_function, logger=None, extra_args=None):
+    '''
+    Consumes 'queue_name' through the default transport instead of a
+    dedicated QueueListener thread.
+    '''
+    return get_transport().subscribe(
+        queue_name, handler_function, logger, extra_args
+    )
+
     
+class Transport():
+    '''
+    Interface of the messaging backends used by Node and
+    TrustedThirdParty. Handlers get the pika-like arguments
+    (channel, method, properties, body) plus any extra_args.
+    '''
+
+    def publish(self, queue_name, body):
+        raise NotImplementedError
+
+    def publish_batch(self, queue_name, bodies):
+        '''
+        Publishes all 'bodies' waiting once for the broker confirms;
+        returns the indexes of the ones not confirmed.
+        '''
+        raise NotImplementedError
+
+    def declare_queues(self, queue_names):
+        '''
+        Declares all 'queue_names' up front, in one batch.
+        '''
+        raise NotImplementedError
+
+    def route(self, exchange, routing_key, body):
+        '''
+        Publishes 'body' on the topic 'exchange' with 'routing_key'.
+        '''
+        raise NotImplementedError
+
+    def bind(self, queue_name, exchange, routing_key):
+        '''
+        Binds 'queue_name' to the topic 'exchange' for the routing keys
+        matching 'routing_key' ('*' is a word, '#' zero or more).
+        '''
+        raise NotImplementedError
+
+    def subscribe(self, queue_name, handler_function, logger=None,
+                  extra_args=None):
+        raise NotImplementedError
+
+    def unsubscribe(self, queue_name):
+        raise NotImplementedError
+
+    def is_subscribed(self, queue_name):
+        raise NotImplementedError
+
+    def stats(self):
+        '''
+        Load figures of the backend (connections, queue depths, waits,
+        rejections), for monitoring.
+        '''
+        return {}
+
+    def close(self):
+        raise NotImplementedError
+
+
+class BlockingTransport(Transport):
+    '''
+    Backend built on blocking pika: publishes through a PublisherPool
+    and consumes through a ConsumerHub.
+    '''
+
+    def __init__(self, conn_params, hub=None):
+        self.conn_params = conn_params
+        self.pool = get_publisher_pool(conn_params)
+        self.hub = hub if hub is not None else ConsumerHub(
+            conn_params, declared=self.pool.declared
+        )
+
+    def publish(self, queue_name, body):
+        self.pool.publish(queue_name, body)
+
+    def publish_batch(self, queue_name, bodies):
+        return self.pool.publish_batch(queue_name, bodies)
+
+    def declare_queues(self, queue_names):
+        self.pool.declare_queues(queue_names)
+
+    def route(self, exchange, routing_key, body):
+        self.pool.route(exchange, routing_key, body)
+
+    def bind(self, queue_name, exchange, routing_key):
+        self.pool.bind(queue_name, exchange, routing_key)
+
+    def subscribe(self, queue_name, handler_function, logger=None,
+                  extra_args=None):
+        return self.hub.subscribe(
+            queue_name, handler_function, logger, extra_args
+        )
+
+    def unsubscribe(self, queue_name):
+        self.hub.unsubscribe(queue_name)
+
+    def is_subscribed(self, queue_name):
+        return self.hub.is_subscribed(queue_name)
+
+    def stats(self):
+        return {
+            'publishers': self.pool.stats(),
+            'consumers': self.hub.stats()
+        }
+
+    def close(self):
+        self.hub.close()
+
+
+class AsyncioTransport(Transport):
+    '''
+    Backend built on pika's AsyncioConnection. One connection and
+    one channel serve every queue and all the handlers run on the
+    event loop, so any number of Nodes and TTPs can share a loop
+    without per-queue threads.
+
+    Besides the coroutines publish_async and consume, the sync
+    methods of Transport are offered: they can be called from the
+    loop or from any other thread (e.g. an InputThread) and only
+    schedule the work. Handlers can be plain functions or coroutine
+    functions; deliveries of the same queue are handled in order.
+    With 'workers', plain handlers run on that many threads instead
+    of blocking the loop; the prefetch limit bounds the deliveries
+    waiting for them.
+
+    The subscriptions are only touched on the loop: when the
+    connection drops, the transport reconnects every
+    'reconnect_delay' seconds and consumes them again.
+    '''
+
+    def __init__(self, conn_params, loop=None, prefetch=64, ack_every=32,
+                 ack_interval=0.2, workers=None, reconnect_delay=1):
+        self.conn_params = conn_params
+        self.loop = loop if loop is not None else asyncio.new_event_loop()
+        self.logger = logging.getLogger('AsyncioTransport')
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+        self.ack_interval = ack_interval
+        self.reconnect_delay = reconnect_delay
+        self.executor = None
+        if workers is not None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='asyncio-transport'
+            )
+        self.conn = None
+        self.ch = None
+        self.batcher = None
+        self._connecting = None
+        self._subs = {}
+        # queues declared on the current connection
+        self._declared = set()
+
+        # channel in publisher confirm mode, used by batches
+        self.confirm_ch = None
+        self._next_tag = 1
+        # delivery tag -> future resolved with True on ack
+        self._unconfirmed = collections.OrderedDict()
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _schedule(self, coro):
+        if self._on_loop():
+            fut = self.loop.create_task(coro)
+        else:
+            fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        # nobody awaits these: failures would go unnoticed otherwise
+        fut.add_done_callback(self._log_failure)
+        return fut
+
+    def _log_failure(self, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            self.logger.error('Scheduled operation failed: %r',
+                              fut.exception())
+
+    def _call_on_loop(self, fn, *args):
+        if self._on_loop():
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _pika_future(self):
+        '''
+        Returns a future and a callback, usable as pika completion
+        callback, resolving it.
+        '''
+        fut = self.loop.create_future()
+
+        def done(*args):
+            if not fut.done():
+                fut.set_result(args[-1] if args else None)
+        return fut, done
+
+    async def connect(self):
+        if self.ch is not None and self.ch.is_open:
+            return
+        if self._connecting is None:
+            self._connecting = self.loop.create_task(self._connect())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            self._connecting = None
+
+    async def _connect(self):
+        opened = self.loop.create_future()
+
+        def on_open_error(conn, err):
+            if not isinstance(err, BaseException):
+                err = pika.exceptions.AMQPConnectionError(err)
+            opened.set_exception(err)
+
+        self.conn = AsyncioConnection(
+            self.conn_params,
+            on_open_callback=opened.set_result,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_conn_closed,
+            custom_ioloop=self.loop
+        )
+        await opened
+
+        ch_opened, done = self._pika_future()
+        self.conn.channel(on_open_callback=done)
+        ch = await ch_opened
+        qos_ok, done = self._pika_future()
+        ch.basic_qos(prefetch_count=self.prefetch, callback=done)
+        await qos_ok
+        self.batcher = AckBatcher(ch, self.ack_every, self.ack_interval)
+        self.loop.call_later(self.ack_interval, self._flush_acks,
+                             self.batcher)
+        self._declared = set()
+        self.ch = ch
+
+    def _flush_acks(self, batcher):
+        if batcher is not self.batcher or not batcher.ch.is_open:
+            return
+        batcher.flush_if_due()
+        self.loop.call_later(self.ack_interval, self._flush_acks, batcher)
+
+    def _on_conn_closed(self, conn, reason):
+        self.logger.info('Connection closed: %s', reason)
+        self.ch = None
+        self.confirm_ch = None
+        for fut in self._unconfirmed.values():
+            if not fut.done():
+                fut.set_result(False)
+        self._unconfirmed.clear()
+        if not self._subs:
+            return
+        # the broker requeues the unacked deliveries: the ones not
+        # handled yet would be handled twice
+        for sub in self._subs.values():
+            sub.consumer_tag = None
+            sub._pending.clear()
+        self._schedule(self._resubscribe(list(self._subs.values())))
+
+    async def _resubscribe(self, subs):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            if not any(self._subs.get(sub.queue) is sub for sub in subs):
+                return
+            try:
+                await self.connect()
+                break
+            except pika.exceptions.AMQPError as e:
+                self.logger.warning('Reconnection failed: %r', e)
+        for sub in subs:
+            if self._subs.get(sub.queue) is sub:
+                await self._start_consume(sub)
+
+    async def _open_confirm_channel(self):
+        ch_opened, done = self._pika_future()
+        self.conn.channel(on_open_callback=done)
+        ch = await ch_opened
+        selected, done = self._pika_future()
+        ch.confirm_delivery(self._on_confirm, callback=done)
+        await selected
+        self._next_tag = 1
+        self.confirm_ch = ch
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            while self._unconfirmed:
+                tag = next(iter(self._unconfirmed))
+                if tag > method.delivery_tag:
+                    break
+                self._unconfirmed.pop(tag).set_result(acked)
+        elif method.delivery_tag in self._unconfirmed:
+            self._unconfirmed.pop(method.delivery_tag).set_result(acked)
+
+    async def _declare(self, queue_name):
+        if queue_name not in self._declared:
+            declared, done = self._pika_future()
+            self.ch.queue_declare(queue_name, callback=done)
+            await declared
+            self._declared.add(queue_name)
+
+    async def declare_queues_async(self, queue_names):
+        '''
+        Declares all the new queues waiting for the last reply only.
+        '''
+        await self.connect()
+        new = [q for q in dict.fromkeys(queue_names)
+               if q not in self._declared]
+        if not new:
+            return
+        for q in new[:-1]:
+            self.ch.queue_declare(q)
+        await self._declare(new[-1])
+        self._declared.update(new)
+
+    async def publish_async(self, queue_name, body):
+        await self.connect()
+        await self._declare(queue_name)
+        self.ch.basic_publish("", queue_name, body)
+
+    async def _declare_exchange(self, exchange):
+        if ('exchange', exchange) not in self._declared:
+            declared, done = self._pika_future()
+            self.ch.exchange_declare(exchange, 'topic', callback=done)
+            await declared
+            self._declared.add(('exchange', exchange))
+
+    async def route_async(self, exchange, routing_key, body):
+        await self.connect()
+        await self._declare_exchange(exchange)
+        self.ch.basic_publish(exchange, routing_key, body)
+
+    async def bind_async(self, queue_name, exchange, routing_key):
+        await self.connect()
+        await self._declare_exchange(exchange)
+        await self._declare(queue_name)
+        bound, done = self._pika_future()
+        self.ch.queue_bind(queue_name, exchange, routing_key, callback=done)
+        await bound
+
+    async def publish_batch_async(self, queue_name, bodies, timeout=10):
+        '''
+        Publishes all 'bodies' on the confirm channel and waits for
+        the confirms of the whole batch. Returns the indexes of the
+        bodies which were not confirmed.
+        '''
+        await self.connect()
+        if self.confirm_ch is None or not self.confirm_ch.is_open:
+            await self._open_confirm_channel()
+        await self._declare(queue_name)
+
+        confirms = []
+        for body in bodies:
+            fut = self.loop.create_future()
+            self._unconfirmed[self._next_tag] = fut
+            self._next_tag += 1
+            self.confirm_ch.basic_publish("", queue_name, body)
+            confirms.append(fut)
+        if confirms:
+            await asyncio.wait(confirms, timeout=timeout)
+        return [i for i, fut in enumerate(confirms)
+                if not fut.done() or not fut.result()]
+
+    async def consume(self, queue_name, handler_function, logger=None,
+                      extra_args=None):
+        '''
+        Starts consuming 'queue_name' and returns its Subscription once
+        the broker confirmed the consumer.
+        '''
+        if extra_args != None:
+            handler_function = functools.partial(
+                handler_function, **extra_args
+            )
+        if queue_name in self._subs:
+            return self._subs[queue_name]
+        sub = Subscription(self, queue_name, handler_function, logger)
+        self._subs[queue_name] = sub
+        await self._start_consume(sub)
+        return sub
+
+    async def _start_consume(self, sub):
+        await self.connect()
+        await self._declare(sub.queue)
+        if sub._cancelled.is_set():
+            return
+        consuming, done = self._pika_future()
+        sub.consumer_tag = self.ch.basic_consume(
+            queue=sub.queue,
+            on_message_callback=functools.partial(self._on_delivery, sub),
+            callback=done
+        )
+        await consuming
+        if sub.logger is not None:
+            sub.logger.info(f' [*] Waiting for messages on {sub.queue}')
+
+    def _on_delivery(self, sub, ch, method, properties, body):
+        if sub._cancelled.is_set():
+            ch.basic_nack(method.delivery_tag, requeue=True)
+            return
+        self.batcher.delivered(method.delivery_tag)
+        sub._pending.append((ch, method, properties, body))
+        if not sub._running:
+            sub._running = True
+            self.loop.create_task(self._drain(sub))
+
+    async def _drain(self, sub):
+        try:
+            while sub._pending and not sub._cancelled.is_set():
+                delivery = sub._pending.popleft()
+                ok = True
+                try:
+                    if (self.executor is not None and
+                            not inspect.iscoroutinefunction(sub.handler)):
+                        await self.loop.run_in_executor(
+                            self.executor,
+                            functools.partial(sub.handler, *delivery)
+                        )
+                    else:
+                        rst = sub.handler(*delivery)
+                        if inspect.isawaitable(rst):
+                            await rst
+                except Exception:
+                    ok = False
+                    self.logger.exception(f'Handler of {sub.queue} failed')
+                ch, method = delivery[0], delivery[1]
+                if self.batcher is not None and ch is self.batcher.ch:
+                    self.batcher.completed(method.delivery_tag, ok,
+                                           method.redelivered)
+        finally:
+            sub._running = False
+
+    def _cancel(self, sub):
+        if (sub.consumer_tag is not None
+                and self.ch is not None and self.ch.is_open):
+            self.ch.basic_cancel(sub.consumer_tag)
+        sub._cancelled.set()
+        # deliveries not handled yet go back to the queue
+        while sub._pending:
+            ch, method = sub._pending.popleft()[:2]
+            if self.batcher is not None and ch is self.batcher.ch:
+                self.batcher.requeue(method.delivery_tag)
+
+    def publish(self, queue_name, body):
+        self._schedule(self.publish_async(queue_name, body))
+
+    def declare_queues(self, queue_names):
+        self._schedule(self.declare_queues_async(list(queue_names)))
+
+    def route(self, exchange, routing_key, body):
+        self._schedule(self.route_async(exchange, routing_key, body))
+
+    def bind(self, queue_name, exchange, routing_key):
+        self._schedule(self.bind_async(queue_name, exchange, routing_key))
+
+    def publish_batch(self, queue_name, bodies):
+        if self._on_loop():
+            raise RuntimeError(
+                'publish_batch would block the event loop, '
+                'await publish_batch_async instead')
+        return asyncio.run_coroutine_threadsafe(
+            self.publish_batch_async(queue_name, bodies), self.loop
+        ).result()
+
+    def subscribe(self, queue_name, handler_function, logger=None,
+                  extra_args=None):
+        if extra_args != None:
+            handler_function = functools.partial(
+                handler_function, **extra_args
+            )
+        sub = self._subs.get(queue_name)
+        if sub is None:
+            sub = Subscription(self, queue_name, handler_function, logger)
+            self._call_on_loop(self._add_sub, sub)
+        return sub
+
+    def _add_sub(self, sub):
+        if sub.queue in self._subs:
+            # subscribed meanwhile by another thread
+            return
+        self._subs[sub.queue] = sub
+        self._schedule(self._start_consume(sub))
+
+    def unsubscribe(self, queue_name):
+        self._call_on_loop(self._remove_sub, queue_name)
+
+    def _remove_sub(self, queue_name):
+        sub = self._subs.pop(queue_name, None)
+        if sub is not None:
+            self._cancel(sub)
+
+    def is_subscribed(self, queue_name):
+        return queue_name in self._subs
+
+    def stats(self):
+        subs = list(self._subs.values())
+        return {
+            'waiting': sum(len(sub._pending) for sub in subs),
+            'acks': self.batcher.stats() if self.batcher is not None else {}
+        }
+
+    def _close(self):
+        for q in list(self._subs):
+            self._cancel(self._subs.pop(q))
+        if self.batcher is not None:
+            self.batcher.flush()
+        if self.conn is not None and self.conn.is_open:
+            self.conn.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def close(self):
+        if self._on_loop():
+            self._close()
+        else:
+            self.loop.call_soon_threadsafe(self._close)
+
+    def run_forever(self):
+        '''
+        Runs the transport's event loop on the calling thread.
+        '''
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+def topic_regex(pattern):
+    '''
+    Compiles an AMQP topic binding pattern: words are separated by
+    '.', '*' matches exactly one word and '#' zero or more words.
+
+    The regex is matched against '.' + routing key (see topic_matches):
+    every word comes with the separator in front of it, so that '#' can
+    match zero words together with its adjacent dot.
+    '''
+    regex = ''
+    prev = None
+    for w in pattern.split('.'):
+        if w == '#':
+            # '#.#' matches the same as '#'
+            if prev != '#':
+                regex += r'(?:\.[^.]*)*'
+        elif w == '*':
+            regex += r'\.[^.]*'
+        else:
+            regex += r'\.' + re.escape(w)
+        prev = w
+    return re.compile(regex)
+
+
+def topic_matches(regex, routing_key):
+    '''
+    Whether routing_key matches the pattern compiled by topic_regex.
+    '''
+    return regex.fullmatch('.' + routing_key) is not None
+
+
+class InMemoryTransport(Transport):
+    '''
+    Broker stand-in keeping named queues in memory, for tests and
+    benchmarks on a single machine. Messages published on a queue
+    without consumer are kept until someone subscribes.
+
+    Handlers run on a pool of worker threads or, when 'loop' is given,
+    on that asyncio event loop (coroutine handlers are awaited). In
+    both cases deliveries of the same queue are handled in order.
+    '''
+
+    def __init__(self, workers=8, loop=None):
+        self.logger = logging.getLogger('InMemoryTransport')
+        self.loop = loop
+        self._queues = collections.defaultdict(collections.deque)
+        self._subs = {}
+        # exchange -> {(routing_key pattern, queue_name): compiled regex}
+        self._bindings = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+        self._delivery_tag = 0
+        self.dispatcher = None
+        if loop is None:
+            self.dispatcher = OrderedDispatcher(
+                workers, 'memory-transport-worker', self.logger
+            )
+
+    def _deliver(self, sub, body, exchange='', routing_key=None):
+        # called with self._lock held
+        self._delivery_tag += 1
+        method = pika.spec.Basic.Deliver(
+            consumer_tag=sub.queue, delivery_tag=self._delivery_tag,
+            exchange=exchange,
+            routing_key=sub.queue if routing_key is None else routing_key
+        )
+        delivery = (None, method, pika.spec.BasicProperties(), body)
+        if self.loop is None:
+            self.dispatcher.dispatch(sub, delivery)
+        else:
+            self.loop.call_soon_threadsafe(self._dispatch_on_loop,
+                                           sub, delivery)
+
+    def _dispatch_on_loop(self, sub, delivery):
+        if sub._cancelled.is_set():
+            return
+        sub._pending.append(delivery)
+        if not sub._running:
+            sub._running = True
+            self.loop.create_task(self._drain(sub))
+
+    async def _drain(self, sub):
+        try:
+            while sub._pending and not sub._cancelled.is_set():
+                delivery = sub._pending.popleft()
+                try:
+                    rst = sub.handler(*delivery)
+                    if inspect.isawaitable(rst):
+                        await rst
+                except Exception:
+                    self.logger.exception(f'Handler of {sub.queue} failed')
+        finally:
+            sub._running = False
+
+    def _enqueue(self, queue_name, body, exchange='', routing_key=None):
+        # called with self._lock held
+        sub = self._subs.get(queue_name)
+        if sub is None:
+            self._queues[queue_name].append((body, exchange, routing_key))
+        else:
+            self._deliver(sub, body, exchange, routing_key)
+
+    def publish(self, queue_name, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self._lock:
+            self._enqueue(queue_name, body)
+
+    def route(self, exchange, routing_key, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self._lock:
+            for (_, queue_name), regex in self._bindings[exchange].items():
+                if topic_matches(regex, routing_key):
+                    self._enqueue(queue_name, body, exchange, routing_key)
+
+    def bind(self, queue_name, exchange, routing_key):
+        regex = topic_regex(routing_key)
+        with self._lock:
+            self._queues[queue_name]
+            self._bindings[exchange][(routing_key, queue_name)] = regex
+
+    def publish_batch(self, queue_name, bodies):
+        for body in bodies:
+            self.publish(queue_name, body)
+        return []
+
+    def declare_queues(self, queue_names):
+        with self._lock:
+            for q in queue_names:
+                self._queues[q]
+
+    def subscribe(self, queue_name, handler_function, logger=None,
+                  extra_args=None):
+        if extra_args != None:
+            handler_function = functools.partial(
+                handler_function, **extra_args
+            )
+        with self._lock:
+            if queue_name in self._subs:
+                return self._subs[queue_name]
+            sub = Subscription(self, queue_name, handler_function, logger)
+            self._subs[queue_name] = sub
+            waiting = self._queues.pop(queue_name, ())
+            for body, exchange, routing_key in waiting:
+                self._deliver(sub, body, exchange, routing_key)
+        if logger is not None:
+            logger.info(f' [*] Waiting for messages on {queue_name}')
+        return sub
+
+    def unsubscribe(self, queue_name):
+        with self._lock:
+            sub = self._subs.pop(queue_name, None)
+        if sub is not None:
+            sub._cancelled.set()
+
+    def is_subscribed(self, queue_name):
+        with self._lock:
+            return queue_name in self._subs
+
+    def depth(self, queue_name):
+        '''
+        Number of messages waiting for a consumer on 'queue_name'.
+        '''
+        with self._lock:
+            return len(self._queues.get(queue_name, ()))
+
+    def stats(self):
+        if self.dispatcher is None:
+            return {}
+        return {'work_queue': self.dispatcher.stats()}
+
+    def close(self):
+        with self._lock:
+            subs, self._subs = self._subs, {}
+        for sub in subs.values():
+            sub._cancelled.set()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+
+
+BACKENDS = {
+    'blocking': lambda: BlockingTransport(get_tls_con_param(),
+                                          get_consumer_hub()),
+    'asyncio': lambda: AsyncioTransport(get_tls_con_param()),
+    'memory': lambda: InMemoryTransport()
+}
+_transports = {}
+_transports_lock = threading.Lock()
+_default_transport = None
+
+def get_transport(backend=None):
+    '''
+    Returns the process-wide transport of the selected backend,
+    'blocking', 'asyncio' or 'memory'. Without a backend, the one set
+    by set_transport is returned, the blocking one otherwise.
+    '''
+    with _transports_lock:
+        if backend is None:
+            if _default_transport is not None:
+                return _default_transport
+            backend = 'blocking'
+        if backend not in _transports:
+            _transports[backend] = BACKENDS[backend]()
+        return _transports[backend]
+
+# process-wide transport -> number of acquire_transport users
+_transport_users = {}
+
+def acquire_transport(backend=None):
+    '''
+    Returns get_transport(backend), counting the caller as one of its
+    users: release_transport closes it when the last one is done.
+    '''
+    transport = get_transport(backend)
+    with _transports_lock:
+        _transport_users[transport] = _transport_users.get(transport, 0) + 1
+    return transport
+
+def release_transport(transport):
+    '''
+    Gives back a transport returned by acquire_transport, closing it
+    if nobody else uses it any more. A later get_transport of the same
+    backend opens a new one.
+    '''
+    with _transports_lock:
+        users = _transport_users.get(transport, 0) - 1
+        if users > 0:
+            _transport_users[transport] = users
+            return
+        _transport_users.pop(transport, None)
+        for backend, t in list(_transports.items()):
+            if t is transport:
+                del _transports[backend]
+    transport.close()
+
+def set_transport(transport):
+    '''
+    Plugs 'transport' under send_message, subscribe, QueueListener and
+    every Node and TrustedThirdParty created without an explicit one.
+    '''
+    global _default_transport
+    with _transports_lock:
+        _default_transport = transport
+
     
 def serialize_pk(pk):
     '''
@@ -173,6 +1863,154 @@ def deactivate_other_loggers():
     pikaLogger.setLevel('WARNING')
 
     
+# level of the loggers configured by complete_logger, e.g.
+# SIGNALPY_LOG_LEVEL=WARNING in production
+LOG_LEVEL = os.environ.get('SIGNALPY_LOG_LEVEL', 'NOTSET')
+# keys, secrets and whole key-state dumps are logged only with
+# SIGNALPY_LOG_KEYS=1, and at DEBUG level
+LOG_KEY_MATERIAL = os.environ.get('SIGNALPY_LOG_KEYS') == '1'
+
+def log_key_material(logger, msg, *args):
+    '''
+    Logs msg % args at DEBUG level if key material logging is on; args
+    are only formatted if the record is emitted.
+    '''
+    if LOG_KEY_MATERIAL and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args)
+
+
+# with SIGNALPY_ASYNC_LOGS=1 the loggers below write through AsyncLogging
+ASYNC_LOGS = os.environ.get('SIGNALPY_ASYNC_LOGS') == '1'
+
+
+class _AsyncLogHandler(logging.handlers.QueueHandler):
+    '''
+    Formats the record on the calling thread and hands it over, with
+    the handlers that must write it, to AsyncLogging; never blocks.
+    '''
+
+    def __init__(self, pipeline, targets):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.targets = tuple(targets)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((self.targets, record))
+            queued = True
+        except queue.Full:
+            queued = False
+        self.pipeline.count(queued)
+
+
+class AsyncLogging(threading.Thread):
+    '''
+    Writes the log records of the wrapped handlers on its own thread,
+    so that the threads logging never wait for the disk. The queue
+    holds at most 'maxsize' records: the ones logged while it is full
+    are dropped and counted. Records are written in batches of up to
+    'batch', with one write and one flush per handler.
+    '''
+
+    def __init__(self, maxsize=10000, batch=256):
+        super().__init__(name='async-logging', daemon=True)
+        self.queue = queue.Queue(maxsize)
+        self.batch = batch
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        # the counters are updated by every logging thread
+        self._stats_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.start()
+
+    def count(self, queued):
+        with self._stats_lock:
+            if queued:
+                self.enqueued += 1
+            else:
+                self.dropped += 1
+
+    def wrap(self, logger):
+        '''
+        Replaces the handlers of logger with one writing through this
+        thread.
+        '''
+        targets = [h for h in logger.handlers
+                   if not isinstance(h, _AsyncLogHandler)]
+        if not targets:
+            return
+        for h in targets:
+            logger.removeHandler(h)
+        logger.addHandler(_AsyncLogHandler(self, targets))
+
+    def run(self):
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            try:
+                entries = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(entries) < self.batch:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(entries)
+
+    def _write(self, entries):
+        by_handler = collections.OrderedDict()
+        for targets, record in entries:
+            for h in targets:
+                if record.levelno >= h.level:
+                    by_handler.setdefault(h, []).append(record)
+        for h, records in by_handler.items():
+            if isinstance(h, logging.StreamHandler) and h.stream is not None:
+                text = ''.join(h.format(r) + h.terminator for r in records)
+                h.acquire()
+                try:
+                    h.stream.write(text)
+                    h.flush()
+                except Exception:
+                    h.handleError(records[-1])
+                finally:
+                    h.release()
+            else:
+                for r in records:
+                    h.handle(r)
+        with self._stats_lock:
+            self.written += len(entries)
+            self.batches += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {'depth': self.queue.qsize(), 'enqueued': self.enqueued,
+                    'dropped': self.dropped, 'written': self.written,
+                    'batches': self.batches}
+
+    def stop(self):
+        '''
+        Writes the queued records and stops the thread.
+        '''
+        self._stop_event.set()
+        self.join()
+
+
+_async_logging = None
+_async_logging_lock = threading.Lock()
+
+def get_async_logging():
+    '''
+    Returns the process-wide AsyncLogging, started on first use.
+    '''
+    global _async_logging
+    with _async_logging_lock:
+        if _async_logging is None:
+            _async_logging = AsyncLogging()
+            atexit.register(_async_logging.stop)
+        return _async_logging
+
+
 def chat_logger(loggerName):
     '''
     It configures a basic logging feature for the chat 
@@ -188,8 +2026,11 @@ def chat_logger(loggerName):
     )
     
     stream_h.setFormatter(formatter)
-    logger.setLevel(logging.NOTSET)
+    # the chat is the user interface: it does not follow LOG_LEVEL
+    logger.setLevel(logging.INFO)
     logger.addHandler(stream_h)
+    if ASYNC_LOGS:
+        get_async_logging().wrap(logger)
     
     return logger
 
@@ -204,15 +2045,80 @@ def complete_logger(loggerName, inFile=False):
     
     if inFile:
         logging.basicConfig(filename=f'logs/{loggerName}.log',
-                        filemode='w+', level=logging.NOTSET,
+                        filemode='w+', level=LOG_LEVEL,
                         format=FORMAT, datefmt=DATE_FORMAT)
     
     else:
-        logging.basicConfig(level=logging.NOTSET,
+        logging.basicConfig(level=LOG_LEVEL,
                         format=FORMAT,
                         datefmt=DATE_FORMAT)
+    if ASYNC_LOGS:
+        get_async_logging().wrap(logging.getLogger())
     logger = logging.getLogger(loggerName)
     
         
     return logger
 
+
+#---------------- testing ----------------------------
+def test_topic_regex():
+    '''
+    Checks topic_regex against the matching rules of the broker.
+    '''
+    cases = {
+        '#': (['', 'a', 'a.b', 'a.b.c'], []),
+        'a.#': (['a', 'a.b', 'a.b.c'], ['b', 'ab', 'b.a']),
+        '#.a': (['a', 'x.a', 'x.y.a'], ['xa', 'a.x']),
+        '#.#': (['a', 'a.b', 'a.b.c'], []),
+        'a.#.b': (['a.b', 'a.x.b', 'a.x.y.b'], ['a.b.c', 'ab', 'x.a.b']),
+        '*': (['a'], ['a.b']),
+        'a.*': (['a.b'], ['a', 'a.b.c', 'b.a']),
+        '*.#': (['a', 'a.b', 'a.b.c'], []),
+        'a.*.#': (['a.b', 'a.b.c'], ['a']),
+        '#.*.b': (['a.b', 'x.a.b'], ['b']),
+        'B.*': (['B.A', 'B.+358 1'], ['B', 'B.A.C', 'A.B']),
+        'a.b': (['a.b'], ['a', 'a.b.c', 'aXb'])
+    }
+    for pattern, (matching, other) in cases.items():
+        regex = topic_regex(pattern)
+        for key in matching:
+            assert topic_matches(regex, key), (pattern, key)
+        for key in other:
+            assert not topic_matches(regex, key), (pattern, key)
+    print('Topic patterns: OK')
+
+def test_ack_batcher():
+    '''
+    A slow delivery must not hold back the acks of the later ones.
+    '''
+    class Channel():
+        is_open = True
+
+        def __init__(self):
+            self.acks = []
+
+        def basic_ack(self, delivery_tag, multiple):
+            self.acks.append((delivery_tag, multiple))
+
+    ch = Channel()
+    batcher = AckBatcher(ch, every=100)
+    for tag in range(1, 7):
+        batcher.delivered(tag)
+    for tag in (1, 2, 4, 5, 6):
+        batcher.completed(tag, True)
+    batcher.flush()
+    # 3 is still handled: 1-2 are acked together, 4-6 one by one
+    assert ch.acks == [(2, True), (4, False), (5, False), (6, False)], \
+        ch.acks
+    batcher.completed(3, True)
+    batcher.flush()
+    assert ch.acks[-1] == (3, True), ch.acks
+    assert batcher.stats()['acked'] == 6
+    assert batcher.stats()['in_flight'] == 0
+    print('Ack batching: OK')
+
+
+if __name__ == '__main__':
+    # python shared.py
+    test_topic_regex()
+    test_ack_batcher()
@@ -4,104 +4,537 @@ bookeeping operations.
 '''
 
 import pika
+import os
+import sys
 import threading
+import time
+import logging
+import multiprocessing
 import shared
 import keys
+import registry
+import sharding
+import wire
 from time import sleep
 
 class TrustedThirdParty():
 
-    def __init__(self):
-        self.registered_users = []
+    def __init__(self, transport=None, on_duplicate='replace',
+                 store_path=None, restore_batch=1000, shard_id=None,
+                 shard_ids=None, epk_low_water=4, coalesce_window=1.0,
+                 user_rate=(2, 10), global_rate=(1000, 2000)):
+        '''
+        transport is the shared.Transport used for talking to the
+        broker; by default the blocking one. on_duplicate tells
+        whether a second registration of the same id replaces the
+        first one ('replace') or is ignored ('reject').
+
+        store_path is the SQLite file where the registered users are
+        kept; the users found there are restored, and their consumers
+        re-subscribed in the background, restore_batch users at a time.
+        The salt seed is kept next to it, in '<store_path>.seed', and
+        reused by a restored registry.
+
+        With shard_id, the TTP is one of the shards in shard_ids (which
+        includes it) and only keeps the users the hash ring assigns to
+        it; the other requests are forwarded to their owners.
+
+        Every handshake consumes one of the one-time ephemeral keys the
+        requester uploaded; the requester is asked to upload more when
+        less than epk_low_water are left.
+
+        Handshake requests are admitted before any work is done on them:
+        a request repeating the same (requester, contact) pair within
+        coalesce_window seconds is dropped, and user_rate and
+        global_rate are the (requests per second, burst) allowed to
+        each requester and to the whole TTP.
+        '''
+        self.epk_low_water = epk_low_water
+        self.coalesce_window = coalesce_window
+        self.user_rate = user_rate
+        self.global_bucket = shared.TokenBucket(*global_rate)
+        self.user_buckets = {}
+        # (requester, contact) -> time of the last admitted request
+        self.recent_requests = {}
+        self.admission = {'admitted': 0, 'coalesced': 0,
+                          'shed_user': 0, 'shed_global': 0}
+        self.admission_lock = threading.Lock()
+        self.shard_id = shard_id
+        self.ring = None
+        if shard_id is not None:
+            self.ring = sharding.HashRing(shard_ids or [shard_id])
+            self.ring.add(shard_id)
         # deactivate other loggers
         shared.deactivate_other_loggers()
-        self.logger = shared.complete_logger('TTP')
+        self.logger = shared.complete_logger(
+            'TTP' if shard_id is None else f'TTP-{shard_id}')
+
+        store = registry.SQLiteStore(store_path) if store_path else None
+        self.registered_users = registry.UserRegistry(
+            on_duplicate, store,
+            loader=lambda bundle: keys.NodePublicInfo(bundle, self.logger)
+        )
+        self.logger.info(f'Restored {len(self.registered_users)} users')
         
+        # the process-wide transport is acquired for good: nodes of
+        # the same process terminating must not close it
+        self.transport = transport if transport is not None \
+            else shared.acquire_transport()
+        self.declare_topology([])
         self.queueListeners = [
-            shared.QueueListener("register", self.register, self.logger)
+            self.transport.subscribe("register", self.register, self.logger),
+            self.transport.subscribe("register_bulk", self.register_bulk,
+                                     self.logger)
         ]
+        if self.ring is not None:
+            self.join_ring()
+        self.restorer = threading.Thread(
+            target=self.restore, args=(restore_batch,),
+            name='ttp-restore', daemon=True
+        )
+        self.restorer.start()
 
         # SaltHelper generates the initial time-based seed,
-        # which is assumed to be accessible to all users
+        # which is assumed to be accessible to all users; when sharded
+        # only shard 0 does
         self.sh = keys.SaltHelper(self.logger)
+        if shard_id is None or shard_id == 0:
+            self.init_seed(store_path)
+
+    def init_seed(self, store_path):
+        '''
+        Publishes the salt seed: the one stored next to store_path if
+        users were restored from it, since their nodes keep using it,
+        a new one for a fresh registry.
+        '''
+        seed_path = f'{store_path}.seed' if store_path else None
+        if (seed_path is not None and len(self.registered_users) > 0
+                and os.path.exists(seed_path)):
+            with open(seed_path, 'r') as f:
+                self.sh.set_seed(f.read())
+            self.logger.info('Reusing the seed of %s', store_path)
+            return
         self.sh.generate_seed()
+        if seed_path is not None:
+            with open(seed_path, 'w') as f:
+                f.write(self.sh.seed0)
+
+    def owns(self, user_id):
+        return self.ring is None or self.ring.owner(user_id) == self.shard_id
+
+    def join_ring(self):
+        '''
+        Subscribes the queues of this shard and announces it to the
+        other shards, which hand over the users it now owns.
+        '''
+        own_queues = {
+            'register': self.register_owned,
+            'register_bulk': self.register_bulk_owned,
+            'handshake': self.handshake,
+            'control': self.on_control
+        }
+        for kind, handler in own_queues.items():
+            self.queueListeners.append(
+                self.transport.subscribe(
+                    sharding.shard_queue(self.shard_id, kind), handler,
+                    self.logger)
+            )
+        self.transport.bind(sharding.shard_queue(self.shard_id, 'control'),
+                            sharding.CONTROL_EXCHANGE, '#')
+        self.transport.route(sharding.CONTROL_EXCHANGE, 'join',
+                             wire.encode_data({'op': 'join',
+                                               'shard': self.shard_id}))
+
+    def leave_ring(self):
+        '''
+        Hands over all the users of this shard to the remaining ones.
+        '''
+        self.transport.route(sharding.CONTROL_EXCHANGE, 'leave',
+                             wire.encode_data({'op': 'leave',
+                                               'shard': self.shard_id}))
+
+    def on_control(self, ch, method, properties, body):
+        change = wire.decode_data(body)
+        self.logger.info(f'Ring change: {change}')
+        if change['op'] == 'join':
+            changed = self.ring.add(change['shard'])
+        else:
+            changed = self.ring.remove(change['shard'])
+        if changed:
+            self.hand_over()
+
+    def hand_over(self):
+        '''
+        Forwards the users this shard does not own anymore to their
+        owners, which re-subscribe their queues.
+        '''
+        moved = 0
+        for uid in self.registered_users.ids():
+            owner = self.ring.owner(uid)
+            if owner == self.shard_id or owner is None:
+                continue
+            bundle = self.registered_users.serialized(uid)
+            self.registered_users.remove(uid)
+            for queue in [f'{uid}_req_pub', f'{uid}_update_initiator_epk']:
+                self.transport.unsubscribe(queue)
+            if bundle is not None:
+                self.transport.publish(
+                    sharding.shard_queue(owner, 'register'), bundle)
+                moved += 1
+        self.logger.info(f'Handed over {moved} users, ring: {self.ring.shards()}')
+
+    def restore(self, batch):
+        if self.ring is not None:
+            self.hand_over()
+        self.restore_consumers(self.registered_users.ids(), batch)
+
+    def declare_topology(self, user_ids):
+        '''
+        Declares in one batch the queues of the given users.
+        '''
+        queues = ['register', 'register_bulk']
+        for uid in user_ids:
+            queues += [f'{uid}_req_pub', f'{uid}_rep_init_pub',
+                       f'{uid}_rep_resp_pub',
+                       f'{uid}_update_initiator_epk']
+        self.transport.declare_queues(queues)
+
+    def subscribe_user(self, user_id):
+        req_queue = f"{user_id}_req_pub"
+        if self.transport.is_subscribed(req_queue):
+            return
+        self.queueListeners.append(
+            self.transport.subscribe(
+                queue_name=req_queue,
+                handler_function=self.send_public,
+                logger=self.logger,
+                extra_args={'resp_id': user_id})
+        )
+
+    def restore_consumers(self, user_ids, batch):
+        '''
+        Re-subscribes the consumers of the restored users, one batch
+        at a time, while the TTP already serves the new requests. The
+        keys of the restored users are only deserialized when a
+        request needs them.
+        '''
+        for i in range(0, len(user_ids), batch):
+            chunk = user_ids[i:i + batch]
+            self.declare_topology(chunk)
+            for uid in chunk:
+                self.subscribe_user(uid)
+                # an epk may have been uploaded while the TTP was down
+                epk_queue = f"{uid}_update_initiator_epk"
+                if not self.transport.is_subscribed(epk_queue):
+                    self.queueListeners.append(
+                        self.transport.subscribe(epk_queue, self.update_epk,
+                                                 self.logger)
+                    )
+        if user_ids:
+            self.logger.info(f'Consumers of {len(user_ids)} users restored')
 
     def get_pub_if_registered(self, searched_id):
-        i = 0
-        rst = None
-        while i < len(self.registered_users):
-            if self.registered_users[i].id == searched_id:
-                rst = self.registered_users[i]
-            i += 1
-        return rst
+        return self.registered_users.get(searched_id)
+
+    def admit(self, init_id, resp_id):
+        '''
+        Tells whether the send public of init_id requested by resp_id
+        should be served, counting the ones that are not.
+        '''
+        now = time.monotonic()
+        with self.admission_lock:
+            last = self.recent_requests.get((resp_id, init_id))
+            if last is not None and now - last < self.coalesce_window:
+                self.admission['coalesced'] += 1
+                return False
+            bucket = self.user_buckets.get(resp_id)
+            if bucket is None:
+                bucket = self.user_buckets[resp_id] = \
+                    shared.TokenBucket(*self.user_rate)
+            if not bucket.take(now):
+                self.admission['shed_user'] += 1
+                return False
+            if not self.global_bucket.take(now):
+                self.admission['shed_global'] += 1
+                return False
+            self.admission['admitted'] += 1
+            if len(self.recent_requests) > 10000:
+                self.recent_requests = {
+                    k: t for k, t in self.recent_requests.items()
+                    if now - t < self.coalesce_window
+                }
+            self.recent_requests[(resp_id, init_id)] = now
+            return True
 
         
-    def send_public(self, ch, method, properties, init_id, resp_pub):
+    def send_public(self, ch, method, properties, init_id, resp_id):
                 
         init_id = init_id.decode('utf-8')
-        self.logger.info(f'New send public of {init_id} requested by {resp_pub.id}')
-        init_pub = self.get_pub_if_registered(init_id)
-        self.logger.debug(f'Info for id {init_id} are {init_pub}')
-        self.logger.debug(f'Currently subscribed users: {self.registered_users}')
+        if not self.admit(init_id, resp_id):
+            return
+        self.logger.info('New send public of %s requested by %s',
+                         init_id, resp_id)
+        # looked up on every request, since a new registration of the
+        # same id may have replaced the keys; the bundles are served
+        # from the registry cache, without touching the keys
+        resp_bundle = self.registered_users.serialized(
+            resp_id, ['prepk', 'epk', 'epks'])
+        if resp_bundle is None:
+            self.logger.info('%s is not registered here', resp_id)
+            return
+        if self.owns(init_id) and init_id not in self.registered_users:
+            # answered before taking an ephemeral key, which would be
+            # burnt for nothing
+            self.transport.publish(f'{resp_id}_rep_init_pub',
+                                   b'NotRegisteredError')
+            return
         # subscribe to channel to receive new ephemeral key
-        self.queueListeners.append(
-            shared.QueueListener(f"{resp_pub.id}_update_initiator_epk",
-                                 self.update_epk, self.logger)
-        )
+        epk_queue = f"{resp_id}_update_initiator_epk"
+        if not self.transport.is_subscribed(epk_queue):
+            self.queueListeners.append(
+                self.transport.subscribe(epk_queue, self.update_epk,
+                                         self.logger)
+            )
+        # a distinct ephemeral key for every handshake, so concurrent
+        # handshakes of the same requester do not wait for a refill
+        epk, left = self.take_epk(resp_id)
+        if epk is None:
+            # without an ephemeral key the handshake cannot be done;
+            # the requester uploads new ones and retries
+            self.transport.publish(
+                f'{resp_id}_rep_init_pub',
+                wire.encode_data({'epk': None, 'left': 0, 'low': True,
+                                  'error': 'NoEphemeralKeyError'})
+            )
+            return
+        resp_bundle = keys.NodePublicInfo.with_epk(resp_bundle, epk)
+        used = {'epk': epk, 'left': left, 'low': left < self.epk_low_water}
+
+        if self.owns(init_id):
+            self.exchange_public(init_id, resp_id, resp_bundle, used)
+        else:
+            # the keys of init_id are on another shard
+            self.transport.publish(
+                sharding.shard_queue(self.ring.owner(init_id), 'handshake'),
+                wire.encode_data({'init_id': init_id, 'resp_id': resp_id,
+                                  'resp_bundle': resp_bundle, 'used': used})
+            )
+
+    def handshake(self, ch, method, properties, body):
+        '''
+        Serves a send public forwarded by the shard of the requester.
+        '''
+        req = wire.decode_data(body)
+        self.exchange_public(req['init_id'], req['resp_id'],
+                             req['resp_bundle'], req['used'])
+
+    def exchange_public(self, init_id, resp_id, resp_bundle, used):
+        '''
+        Sends the keys of init_id to resp_id and resp_bundle to
+        init_id, if registered. used tells resp_id which of its
+        ephemeral keys went into resp_bundle and how many are left;
+        it is sent back with the error too, so that resp_id forgets
+        the key.
+        '''
+        init_bundle = self.registered_users.serialized(
+            init_id, ['epk', 'epks'])
+        self.logger.debug('Currently registered users: %s',
+                          len(self.registered_users))
         
-        if init_pub is not None:
-            msg_back_to_snd = init_pub.serialize(except_for=['epk'])
+        if init_bundle is not None:
+            msg_back_to_snd = wire.encode_data(
+                dict(used, bundle=init_bundle))
 
-            shared.send_message(f'{init_id}_rep_resp_pub',
-                                resp_pub.serialize(except_for=['prepk']))
+            self.transport.publish(f'{init_id}_rep_resp_pub', resp_bundle)
         else:
-            msg_back_to_snd = b'NotRegisteredError'
+            msg_back_to_snd = wire.encode_data(
+                dict(used, error='NotRegisteredError'))
             
-        shared.send_message(f'{resp_pub.id}_rep_init_pub', msg_back_to_snd)
-
-        self.forget_epk(resp_pub.id)
+        self.transport.publish(f'{resp_id}_rep_init_pub', msg_back_to_snd)
 
     def log_registered_users(self):
-        self.logger.info('All registered users:')
-        for ru in self.registered_users:
-            self.logger.info(ru)
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if shared.LOG_KEY_MATERIAL:
+            self.logger.info('All registered users:')
+            for ru in self.registered_users:
+                shared.log_key_material(self.logger, '%s', ru)
+        self.logger.info('Registry: %s', self.registered_users.stats())
+        self.logger.info('Admission: %s', self.admission)
+        self.logger.info('Transport: %s', self.transport.stats())
         
     def update_epk(self, ch, method, properties, init_pub_new_eph_ser):
         init_pub_new_eph = keys.NodePublicInfo(
             init_pub_new_eph_ser,
             self.logger
         )
-        self.logger.info(f'Updating ephemeral key {init_pub_new_eph.id}')
-        stored_init_pub = self.get_pub_if_registered(init_pub_new_eph.id)
-        stored_init_pub.union(init_pub_new_eph_ser)
+        self.logger.info('Updating ephemeral key %s', init_pub_new_eph.id)
+
+        def add_epks(pub):
+            if init_pub_new_eph.epk is not None:
+                pub.epk = init_pub_new_eph.epk
+            pooled = set(pub.epks)
+            pub.epks += [e for e in init_pub_new_eph.epks if e not in pooled]
+        stored_init_pub = self.registered_users.update(
+            init_pub_new_eph.id, add_epks
+        )
+        if stored_init_pub is None:
+            self.logger.info('%s is not registered', init_pub_new_eph.id)
+            return
         self.logger.info('Initiator updated pubs.')
         self.log_registered_users()
 
         
-    def forget_epk(self, init_id):
-        self.logger.info('Deleting ephemeral X3DH key of Initiator.')
-        init_pub = self.get_pub_if_registered(init_id)
-        init_pub.epk = None
-        self.logger.info(f'Initiator pubs: {init_pub}')
+    def take_epk(self, init_id):
+        '''
+        Removes one ephemeral key of the Initiator; returns it together
+        with the number of one-time keys left.
+        '''
+        self.logger.info('Taking an ephemeral X3DH key of Initiator.')
+        taken = self.registered_users.take_epk(init_id)
+        epk, left = taken if taken is not None else (None, 0)
+        if epk is None:
+            self.logger.info('No ephemeral key left for %s', init_id)
+        return epk, left
 
         
     def register(self, ch, method, properties, cur_pub_info):
-        # TODO_IFF_TIME: check user is unique and implement mechanism for
-        # communicating errors 
-        self.logger.debug(cur_pub_info)
+        cur_id = keys.NodePublicInfo.peek_id(cur_pub_info)
+        if not self.owns(cur_id):
+            owner = self.ring.owner(cur_id)
+            self.transport.publish(sharding.shard_queue(owner, 'register'),
+                                   cur_pub_info)
+            return
+        self.register_owned(ch, method, properties, cur_pub_info)
+
+    def register_owned(self, ch, method, properties, cur_pub_info):
+        # TODO_IFF_TIME: implement mechanism for communicating errors
         cur_pub_info = keys.NodePublicInfo(cur_pub_info, self.logger)
-        self.logger.info("Registering user %r" % cur_pub_info.id)
-        self.registered_users.append(cur_pub_info)
-        
-        cur_queue_list = shared.QueueListener(
-            queue_name=f"{cur_pub_info.id}_req_pub",
-            handler_function=self.send_public,
-            logger=self.logger,
-            over_tls=True,
-            extra_args={'resp_pub': cur_pub_info})
-
-        self.queueListeners.append(cur_queue_list)
+        self.logger.info('Registering user %r', cur_pub_info.id)
+        if not self.registered_users.add(cur_pub_info):
+            self.logger.info('%s already registered, ignored',
+                             cur_pub_info.id)
+            return
+
+        self.subscribe_user(cur_pub_info.id)
         
+    def register_bulk(self, ch, method, properties, body):
+        '''
+        Registers many users at once. body is a dict with 'bundles',
+        the list of serialized public infos, and 'reply_to', the queue
+        receiving the list of per-user results
+        {'index': ..., 'id': ..., 'status': 'registered'|'duplicate'|
+        'invalid'|'forwarded'}, where index is the position of the
+        bundle in the request. The users owned by other shards are
+        forwarded to them in one message per shard, and their results
+        are sent to reply_to by those shards. Requests and results are
+        encoded with wire.encode_data; pickled requests are still read.
+        '''
+        req = wire.decode_data(body)
+        if self.ring is None:
+            self.register_bulk_owned(ch, method, properties, body)
+            return
+        by_owner = {}
+        for i, bundle in enumerate(req['bundles']):
+            try:
+                owner = self.ring.owner(keys.NodePublicInfo.peek_id(bundle))
+            except Exception:
+                owner = self.shard_id
+            by_owner.setdefault(owner, []).append(i)
+        results = [None] * len(req['bundles'])
+        for owner, indexes in by_owner.items():
+            if owner == self.shard_id:
+                continue
+            bundles = [req['bundles'][i] for i in indexes]
+            self.transport.publish(
+                sharding.shard_queue(owner, 'register_bulk'),
+                wire.encode_data({'reply_to': req['reply_to'],
+                                  'bundles': bundles, 'indexes': indexes})
+            )
+            for i, b in zip(indexes, bundles):
+                results[i] = {'index': i,
+                              'id': keys.NodePublicInfo.peek_id(b),
+                              'status': 'forwarded'}
+        indexes = by_owner.get(self.shard_id, [])
+        own = self.register_many([req['bundles'][i] for i in indexes],
+                                 indexes)
+        for i, result in zip(indexes, own):
+            results[i] = result
+        self.transport.publish(req['reply_to'], wire.encode_data(results))
+
+    def register_bulk_owned(self, ch, method, properties, body):
+        req = wire.decode_data(body)
+        results = self.register_many(req['bundles'], req.get('indexes'))
+        self.transport.publish(req['reply_to'], wire.encode_data(results))
+
+    def register_many(self, bundles, indexes=None):
+        '''
+        Deserializes bundles in one pass, adds them to the registry in
+        one transaction and subscribes their request queues in one
+        batch. Returns one result per bundle, in the same order;
+        indexes are the positions of the bundles in the request,
+        by default their positions in bundles.
+        '''
+        if indexes is None:
+            indexes = range(len(bundles))
+        results = []
+        pubs = []
+        for i, bundle in zip(indexes, bundles):
+            try:
+                pubs.append(keys.NodePublicInfo(bundle, self.logger))
+                results.append({'index': i, 'id': pubs[-1].id})
+            except Exception as e:
+                self.logger.info('Invalid bundle %s in bulk registration: %s',
+                                 i, e)
+                try:
+                    user_id = keys.NodePublicInfo.peek_id(bundle)
+                except Exception:
+                    user_id = None
+                results.append({'index': i, 'id': user_id,
+                                'status': 'invalid'})
+        added = iter(self.registered_users.add_many(pubs))
+        for result in results:
+            if 'status' not in result:
+                result['status'] = 'registered' if next(added) \
+                    else 'duplicate'
+        new_ids = [r['id'] for r in results if r['status'] == 'registered']
+        self.declare_topology(new_ids)
+        for uid in new_ids:
+            self.subscribe_user(uid)
+        self.logger.info('Bulk registered %s of %s users', len(new_ids),
+                         len(bundles))
+        return results
+
+def run_shard(backend, store_path, shard_id, shard_ids):
+    '''
+    Runs shard shard_id of a sharded TTP in the current process; each
+    shard keeps its users in its own store file.
+    '''
+    if store_path:
+        root, ext = os.path.splitext(store_path)
+        store_path = f'{root}-{shard_id}{ext}'
+    ttp = TrustedThirdParty(shared.get_transport(backend),
+                            store_path=store_path, shard_id=shard_id,
+                            shard_ids=shard_ids)
+    if backend == 'asyncio':
+        ttp.transport.run_forever()
+    else:
+        threading.Event().wait()
+
 if __name__ == "__main__":
-    ttp = TrustedThirdParty()
+    # python ttp.py [blocking|asyncio] [registry.db] [shards]
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'blocking'
+    store_path = sys.argv[2] if len(sys.argv) > 2 else None
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    if shards > 0:
+        for i in range(shards):
+            multiprocessing.Process(
+                target=run_shard, name=f'ttp-shard-{i}',
+                args=(backend, store_path, i, list(range(shards)))
+            ).start()
+    else:
+        ttp = TrustedThirdParty(shared.get_transport(backend),
+                                store_path=store_path)
+        if backend == 'asyncio':
+            ttp.transport.run_forever()
         
@@ -0,0 +1,426 @@
+'''
+Binary wire format of the chat messages (MsgHolder) and of the public
+key bundles (NodeInfo/NodePublicInfo), replacing pickle.
+
+Every encoding starts with a header: MAGIC, the format VERSION and the
+kind of payload.
+
+  message: j (uint32), pn (uint32), rchpk (uint16 length + bytes),
+           nonce (uint8 length + bytes), msg (uint32 length + bytes)
+  bundle:  a sequence of fields, each a tag (uint8), a length (uint32)
+           and the value; absent fields are omitted and 'epks' is
+           repeated once per key
+  data:    one value of the TTP requests and replies: a type (uint8)
+           followed by nothing (None, False, True), an int64, a
+           length (uint32) and bytes or UTF-8 text, or a count
+           (uint32) and the items of a list or the key (uint16
+           length + UTF-8) and value pairs of a dict
+
+Version 1 messages have no pn, the length of the previous chain of
+the sender; they are still read, with pn None. Bundles are the same in
+both versions.
+
+All integers are big-endian. The ciphertext of a decoded message is a
+memoryview of the input, so it is not copied.
+
+Payloads without the header are read as the old pickle format, by an
+unpickler refusing any class: plain dicts, lists, bytes, strings and
+numbers only.
+'''
+
+import io
+import pickle
+import struct
+import sys
+import time
+
+MAGIC = b'SP'
+VERSION = 2
+# versions which can be decoded
+READABLE_VERSIONS = (1, 2)
+
+MESSAGE = 1
+BUNDLE = 2
+DATA = 3
+
+_HEADER = struct.Struct('!2sBB')
+# header, j, pn and length of rchpk
+_MSG_PREFIX = struct.Struct('!2sBBIIH')
+# the same, in version 1
+_MSG_PREFIX_V1 = struct.Struct('!2sBBIH')
+_LEN8 = struct.Struct('!B')
+_LEN32 = struct.Struct('!I')
+_FIELD = struct.Struct('!BI')
+_TYPE = struct.Struct('!B')
+_INT = struct.Struct('!Bq')
+_SIZED = struct.Struct('!BI')
+_KEY = struct.Struct('!H')
+
+# data value types
+_NONE, _FALSE, _TRUE, _INTEGER, _BYTES, _TEXT, _LIST, _DICT = range(8)
+# nesting allowed in data, e.g. a list of result dicts
+_MAX_DEPTH = 16
+
+# bundle field -> tag; prepk is a dict split in two fields
+_BUNDLE_TAGS = {
+    'id': 1,
+    'ipk': 2,
+    'prepk_pk': 3,
+    'prepk_sign': 4,
+    'epk': 5,
+    'epks': 6,
+    'suite': 7,
+    'ispk': 8
+}
+_BUNDLE_FIELDS = {tag: name for name, tag in _BUNDLE_TAGS.items()}
+_EPKS_TAG = _BUNDLE_TAGS['epks']
+_PREPK_PK_TAG = _BUNDLE_TAGS['prepk_pk']
+_PREPK_SIGN_TAG = _BUNDLE_TAGS['prepk_sign']
+# fields carried as text
+_TEXT_FIELDS = ('id', 'suite')
+
+
+class WireError(ValueError):
+    pass
+
+
+class _PlainUnpickler(pickle.Unpickler):
+    '''
+    Unpickler of the old format, refusing to load any class.
+    '''
+    def find_class(self, module, name):
+        raise WireError(f'Refusing to unpickle {module}.{name}')
+
+
+def safe_loads(data):
+    '''
+    Unpickles data made of builtin containers and scalars only. Any
+    malformed input raises WireError.
+    '''
+    try:
+        return _PlainUnpickler(io.BytesIO(data)).load()
+    except WireError:
+        raise
+    except Exception as e:
+        # a corrupted pickle can fail in many ways: UnpicklingError,
+        # EOFError, UnicodeDecodeError, IndexError...
+        raise WireError(f'Malformed legacy payload: {e!r}') from e
+
+
+def _kind(data):
+    if data[:2] != MAGIC:
+        return None
+    if len(data) < _HEADER.size:
+        raise WireError('Truncated header')
+    magic, version, kind = _HEADER.unpack_from(data)
+    if version not in READABLE_VERSIONS:
+        raise WireError(f'Unsupported wire version {version}')
+    return version, kind
+
+
+def encode_message(j, rchpk, nonce, msg, pn=0):
+    return b''.join([
+        _MSG_PREFIX.pack(MAGIC, VERSION, MESSAGE, j, pn, len(rchpk)), rchpk,
+        _LEN8.pack(len(nonce)), nonce,
+        _LEN32.pack(len(msg)), msg
+    ])
+
+
+def decode_message(data):
+    '''
+    Returns the dict {'msg', 'nonce', 'rchpk', 'j', 'pn'}; 'msg' is a
+    memoryview of data.
+    '''
+    header = _kind(data)
+    if header is None:
+        return safe_loads(data)
+    version, kind = header
+    if kind != MESSAGE:
+        raise WireError(f'Expected a message, got kind {kind}')
+    try:
+        if version == 1:
+            magic, version, kind, j, rchpk_len = \
+                _MSG_PREFIX_V1.unpack_from(data)
+            pn = None
+            off = _MSG_PREFIX_V1.size
+        else:
+            magic, version, kind, j, pn, rchpk_len = \
+                _MSG_PREFIX.unpack_from(data)
+            off = _MSG_PREFIX.size
+        rchpk = data[off:off + rchpk_len]
+        off += rchpk_len
+        nonce_len = data[off]
+        nonce = data[off + 1:off + 1 + nonce_len]
+        off += 1 + nonce_len
+        msg_len, = _LEN32.unpack_from(data, off)
+        off += _LEN32.size
+    except (struct.error, IndexError) as e:
+        raise WireError(f'Truncated message: {e}')
+    if len(nonce) != nonce_len or off + msg_len != len(data):
+        raise WireError('Message length mismatch')
+    return {'msg': memoryview(data)[off:], 'nonce': nonce, 'rchpk': rchpk,
+            'j': j, 'pn': pn}
+
+
+def encode_bundle(data):
+    '''
+    Encodes a bundle dict, as built by NodeInfo.serialize; None values
+    are omitted.
+    '''
+    pack = _FIELD.pack
+    parts = [_HEADER.pack(MAGIC, VERSION, BUNDLE)]
+    for name, value in data.items():
+        if value is None:
+            continue
+        if name == 'epks':
+            for v in value:
+                parts += [pack(_EPKS_TAG, len(v)), v]
+            continue
+        if name == 'prepk':
+            parts += [pack(_PREPK_PK_TAG, len(value['pk'])), value['pk'],
+                      pack(_PREPK_SIGN_TAG, len(value['sign'])),
+                      value['sign']]
+            continue
+        if name in _TEXT_FIELDS:
+            value = value.encode('utf-8')
+        parts += [pack(_BUNDLE_TAGS[name], len(value)), value]
+    return b''.join(parts)
+
+
+def decode_bundle(data):
+    '''
+    Returns the bundle dict encoded in data, in either format.
+    '''
+    header = _kind(data)
+    if header is None:
+        return safe_loads(data)
+    version, kind = header
+    if kind != BUNDLE:
+        raise WireError(f'Expected a bundle, got kind {kind}')
+    rst = {}
+    epks = []
+    off = _HEADER.size
+    end = len(data)
+    unpack = _FIELD.unpack_from
+    while off < end:
+        try:
+            tag, n = unpack(data, off)
+        except struct.error as e:
+            raise WireError(f'Truncated bundle: {e}')
+        off += _FIELD.size
+        value = data[off:off + n]
+        off += n
+        if len(value) != n:
+            raise WireError('Bundle field length mismatch')
+        if tag == _EPKS_TAG:
+            epks.append(value)
+        elif tag in _BUNDLE_FIELDS:
+            # unknown tags are fields of a later minor revision
+            rst[_BUNDLE_FIELDS[tag]] = value
+    if epks:
+        rst['epks'] = epks
+    try:
+        for name in _TEXT_FIELDS:
+            if name in rst:
+                rst[name] = rst[name].decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise WireError(f'Malformed bundle text field: {e}') from e
+    if 'prepk_pk' in rst:
+        rst['prepk'] = {'pk': rst.pop('prepk_pk'),
+                        'sign': rst.pop('prepk_sign', None)}
+    return rst
+
+
+def _encode_value(value, parts, depth):
+    if depth > _MAX_DEPTH:
+        raise WireError('Data nested too deeply')
+    if value is None:
+        parts.append(_TYPE.pack(_NONE))
+    elif value is True or value is False:
+        parts.append(_TYPE.pack(_TRUE if value else _FALSE))
+    elif isinstance(value, int):
+        parts.append(_INT.pack(_INTEGER, value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts += [_SIZED.pack(_BYTES, len(value)), value]
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+        parts += [_SIZED.pack(_TEXT, len(value)), value]
+    elif isinstance(value, (list, tuple)):
+        parts.append(_SIZED.pack(_LIST, len(value)))
+        for v in value:
+            _encode_value(v, parts, depth + 1)
+    elif isinstance(value, dict):
+        parts.append(_SIZED.pack(_DICT, len(value)))
+        for k, v in value.items():
+            k = k.encode('utf-8')
+            parts += [_KEY.pack(len(k)), k]
+            _encode_value(v, parts, depth + 1)
+    else:
+        raise TypeError(f'Cannot encode {type(value).__name__}')
+
+
+def encode_data(value):
+    '''
+    Encodes a request or reply of the TTP: None, bools, ints, bytes,
+    strings, and lists and dicts (with string keys) of them.
+    '''
+    parts = [_HEADER.pack(MAGIC, VERSION, DATA)]
+    _encode_value(value, parts, 0)
+    return b''.join(parts)
+
+
+def _decode_value(data, off, depth):
+    if depth > _MAX_DEPTH:
+        raise WireError('Data nested too deeply')
+    t = data[off]
+    if t == _NONE:
+        return None, off + 1
+    if t == _FALSE or t == _TRUE:
+        return t == _TRUE, off + 1
+    if t == _INTEGER:
+        return _INT.unpack_from(data, off)[1], off + _INT.size
+    if t > _DICT:
+        raise WireError(f'Unknown data type {t}')
+    t, n = _SIZED.unpack_from(data, off)
+    off += _SIZED.size
+    if t == _BYTES or t == _TEXT:
+        value = data[off:off + n]
+        if len(value) != n:
+            raise WireError('Data length mismatch')
+        return (value if t == _BYTES else value.decode('utf-8')), off + n
+    if t == _LIST:
+        value = []
+        for i in range(n):
+            v, off = _decode_value(data, off, depth + 1)
+            value.append(v)
+        return value, off
+    value = {}
+    for i in range(n):
+        k_len, = _KEY.unpack_from(data, off)
+        off += _KEY.size
+        k = data[off:off + k_len]
+        if len(k) != k_len:
+            raise WireError('Data length mismatch')
+        value[k.decode('utf-8')], off = \
+            _decode_value(data, off + k_len, depth + 1)
+    return value, off
+
+
+def decode_data(data):
+    '''
+    Returns the value encoded in data by encode_data, or pickled in
+    the old format.
+    '''
+    header = _kind(data)
+    if header is None:
+        return safe_loads(data)
+    version, kind = header
+    if kind != DATA:
+        raise WireError(f'Expected data, got kind {kind}')
+    try:
+        value, off = _decode_value(data, _HEADER.size, 0)
+    except (struct.error, IndexError) as e:
+        raise WireError(f'Truncated data: {e}') from e
+    except UnicodeDecodeError as e:
+        raise WireError(f'Malformed data text: {e}') from e
+    if off != len(data):
+        raise WireError('Data length mismatch')
+    return value
+
+
+def _benchmark(n=100000):
+    import os
+    msg = {'msg': os.urandom(200), 'nonce': os.urandom(12),
+           'rchpk': os.urandom(33), 'j': 7}
+    bundle = {'id': '+358 111 222 333', 'ipk': os.urandom(33),
+              'prepk': {'pk': os.urandom(33), 'sign': os.urandom(72)},
+              'epk': os.urandom(33),
+              'epks': [os.urandom(33) for i in range(16)],
+              'suite': 'secp256k1'}
+    cases = [
+        ('message', msg,
+         lambda m: encode_message(m['j'], m['rchpk'], m['nonce'], m['msg']),
+         decode_message),
+        ('bundle', bundle, encode_bundle, decode_bundle)
+    ]
+    for name, value, encode, decode in cases:
+        for fmt, enc, dec in [('pickle', pickle.dumps, pickle.loads),
+                              ('wire', encode, decode)]:
+            start = time.perf_counter()
+            for i in range(n):
+                data = enc(value)
+            enc_t = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(n):
+                dec(data)
+            dec_t = time.perf_counter() - start
+            print(f'{name:8} {fmt:7} {len(data):5} B  '
+                  f'encode {n / enc_t:10.0f}/s  decode {n / dec_t:10.0f}/s')
+
+
+def test_wire():
+    '''
+    Round trips, version 1 messages, legacy pickles and malformed
+    input.
+    '''
+    import os
+    rchpk, nonce, ct = os.urandom(33), os.urandom(12), os.urandom(80)
+    data = encode_message(7, rchpk, nonce, ct, pn=3)
+    msg = decode_message(data)
+    assert (msg['j'], msg['pn'], msg['rchpk'], msg['nonce']) == \
+        (7, 3, rchpk, nonce)
+    assert bytes(msg['msg']) == ct
+
+    bundle = {'id': '+358 111 222 333', 'ipk': os.urandom(33),
+              'prepk': {'pk': os.urandom(33), 'sign': os.urandom(72)},
+              'epk': os.urandom(33),
+              'epks': [os.urandom(33) for i in range(3)],
+              'suite': 'x25519'}
+    assert decode_bundle(encode_bundle(bundle)) == bundle
+    assert decode_bundle(encode_bundle(dict(bundle, epk=None, epks=[]))) \
+        == {k: v for k, v in bundle.items() if k not in ('epk', 'epks')}
+
+    reply = {'epk': os.urandom(33), 'left': 3, 'low': False, 'error': None,
+             'results': [{'index': -1, 'id': 'é', 'status': ''}, []]}
+    assert decode_data(encode_data(reply)) == reply
+
+    # version 1: no pn
+    v1 = b''.join([_MSG_PREFIX_V1.pack(MAGIC, 1, MESSAGE, 7, len(rchpk)),
+                   rchpk, _LEN8.pack(len(nonce)), nonce,
+                   _LEN32.pack(len(ct)), ct])
+    msg = decode_message(v1)
+    assert (msg['j'], msg['pn'], bytes(msg['msg'])) == (7, None, ct)
+    v1 = encode_bundle(bundle)
+    v1 = v1[:2] + bytes([1]) + v1[3:]
+    assert decode_bundle(v1) == bundle
+
+    # the old pickle format, restricted to plain values
+    assert decode_bundle(pickle.dumps(bundle)) == bundle
+    assert decode_data(pickle.dumps(reply)) == reply
+
+    malformed = [
+        data[:-1], data + b'x', data[:5], b'SP', b'SP\x09\x01',
+        encode_bundle(bundle)[:-1],
+        # an id which is not UTF-8
+        _HEADER.pack(MAGIC, VERSION, BUNDLE) + _FIELD.pack(1, 2) + b'\xff\xfe',
+        encode_data(reply)[:-1], encode_data(reply) + b'x',
+        _HEADER.pack(MAGIC, VERSION, DATA) + bytes([99]),
+        _HEADER.pack(MAGIC, VERSION, DATA) + _SIZED.pack(_LIST, 1) * 20
+        + _TYPE.pack(_NONE),
+        b'', b'\x80', pickle.dumps(bundle)[:-2], b'\x80\x04garbage',
+        pickle.dumps(WireError('x'))
+    ]
+    for bad in malformed:
+        for decode in (decode_message, decode_bundle, decode_data):
+            try:
+                decode(bad)
+            except WireError:
+                continue
+            raise AssertionError(f'{decode.__name__} accepted {bad!r}')
+    print('Wire format: OK')
+
+
+if __name__ == '__main__':
+    # python wire.py [iterations]
+    test_wire()
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)